@@ -1,4 +1,4 @@
 from helper_functions import *
 from dummy_roach.dummy_roach import DummyRoach
-from qdr.qdr import Qdr
+from qdr.qdr import Qdr, QdrCalCache, calibrate_all_qdrs
 from instruments import visa_generator, vna_e8364c, generator, rigol_dp832
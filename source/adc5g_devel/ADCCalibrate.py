@@ -12,10 +12,10 @@ from matplotlib.pyplot import *
 
 #import AdcCalLoggingFileHandler
 from SPI import SPI
-from MMCM import MMCM
+from MMCM import MMCM, MMCMPhaseCache
 #from GPIB import GPIB
 from INL import INL
-from OGP import OGP
+from OGP import OGP, do_ogp_parallel
 #from ADCConfFile import ADCConfFile
 from AdcSnapshot import AdcSnapshot
 
@@ -90,6 +90,7 @@ class ADCCalibrate:
                      , dir = dir)
         self.inl = INL(zdok = zdok
                      , spi = self.spi
+                     , adc = self.adc
                      , roach_name = roach_name
                      , now = now
                      , dir = dir)
@@ -99,6 +100,9 @@ class ADCCalibrate:
         self.configPath = "%s/%s" % (dir, self.configFile)
         #self.cf = ADCConfFile(self.configPath)
 
+        # optimal MMCM phases of all boards calibrated from this dir
+        self.mmcmCachePath = "%s/mmcm_cache.json" % dir
+
         self.n_cores = 4
         self.cores = range(1,self.n_cores+1)
 
@@ -167,7 +171,10 @@ class ADCCalibrate:
                         , use_conf = False
                         , freq = None):
 
-        "Loads the most recent ogp, inl calibration files and loads them into the ADC Cards."
+        """
+        Loads the most recent ogp, inl calibration files and loads them into the ADC Cards.
+        Type 'regs' loads instead the register images saved by save_register_images.
+        """
 
         # where to find the calibration files?
         if indir is None:
@@ -190,9 +197,9 @@ class ADCCalibrate:
             raise Exception, msg 
 
         # which type of calibration?
-        allTypes = ['ogp', 'inl']
+        allTypes = ['ogp', 'inl', 'regs']
         if types is None:
-            types = allTypes 
+            types = ['ogp', 'inl']
         else:
             if not all([t in allTypes for t in types]):
                 msg = "Types %s not in %s" % (types, allTypes)
@@ -204,6 +211,10 @@ class ADCCalibrate:
             logger.debug(msg)
             raise Exception, msg
 
+        # the ADCs may have been reset or reprogrammed: write every register
+        for zdok in zdoks:
+            self.spi.invalidate_shadow(zdok)
+
         if use_conf:
             self.load_calibrations_from_conf(indir, zdoks, types, freq)
         else:
@@ -213,7 +224,7 @@ class ADCCalibrate:
             self.loaded_files = []
             for type in types: 
                 for zdok in zdoks:
-                    ext = "" if type == 'ogp' else ".meas"
+                    ext = {'ogp': "", 'inl': ".meas", 'regs': ".npz"}[type]
                     base_name = "%s_%s_z%s_*%s" % (type, self.roach_name, zdok, ext)
                     # Rely on the timestamp at the end of the file name to make sure we
                     # get the most recent file
@@ -223,6 +234,9 @@ class ADCCalibrate:
                         f = "%s/%s" % (indir, files[0])
                         if type == 'ogp':
                             self.ogp.load_from_file(f, zdok = zdok)
+                        elif type == 'regs':
+                            self.spi.set_zdok(zdok)
+                            self.spi.apply_register_image(f)
                         else:    
                             self.inl.load_from_file(f, zdok = zdok)
                         logger.info("Loading file for calibration: %s" % f)    
@@ -233,6 +247,24 @@ class ADCCalibrate:
                         raise Exception, msg 
                     
                     
+    def get_register_image_filename(self, zdok):
+        return "%s/regs_%s_z%d_%s.npz" % (self.dir
+                                        , self.roach_name
+                                        , zdok
+                                        , self.current_time)
+
+    def save_register_images(self, zdoks):
+        """
+        Save the calibrated ADC registers of a single zdok, or both, to
+        register images that load_calibrations(types = ['regs']) loads in
+        one pass.
+        """
+        for zdok in (range(2) if zdoks == 2 else [zdoks]):
+            self.spi.set_zdok(zdok)
+            f = self.get_register_image_filename(zdok)
+            self.spi.save_register_image(f)
+            logger.info("Saved register image: %s" % f)
+
     def load_calibrations_from_conf(self, indir, zdoks, types, freq):
         "Load calibrations from the <roach>-adc.conf file found in given directory."
         filename = "%s/%s" % (indir, self.configFile)
@@ -253,9 +285,16 @@ class ADCCalibrate:
 
 
 
-    def do_ogp(self, zdoks, freq, n_trails):
-        "Handles single zdok, or both"
-        if zdoks==2:
+    def do_ogp(self, zdoks, freq, n_trails, processes=None):
+        """
+        Handles single zdok, or both.  If processes is given, fitting runs
+        in a pool of worker processes, concurrently with the capture of the
+        snapshots of both zdoks, and the per-stage timings are returned, see
+        do_ogp_boards.
+        """
+        if processes is not None:
+            return do_ogp_boards([self], zdoks, freq, n_trails, processes)
+        elif zdoks==2:
            #self.gpib.set_freq(freq)
            self.do_ogp(0, freq, n_trails)
            self.do_ogp(1, freq, n_trails)
@@ -264,40 +303,80 @@ class ADCCalibrate:
         else:
            #self.gpib.set_freq(freq)
            self.ogp.do_ogp(zdoks, freq, n_trails)
-           if self.config:
-               self.cf.write_ogps(self.clockrate*1e6, zdoks, self.ogp.ogps)
-               self.cf.write_to_file()
+           self.write_ogp_config(zdoks, self.ogp.ogps)
+
+    def write_ogp_config(self, zdok, ogps):
+        if self.config:
+            self.cf.write_ogps(self.clockrate*1e6, zdok, ogps)
+            self.cf.write_to_file()
            
 
-    def do_inl(self, zdoks):
-        "Handles single zdok, or both"
+    def do_inl(self, zdoks, hist = False, max_error = 0.05):
+        """
+        Handles single zdok, or both.  Uses the code residuals kept in memory
+        by a previous do_ogp, if any.  If hist is set, a code density test
+        of snapshots is used instead, see INL.do_inl_hist.
+        """
         if zdoks==2:
-           self.do_inl(0)
-           self.do_inl(1)
+           self.do_inl(0, hist, max_error)
+           self.do_inl(1, hist, max_error)
         elif zdoks!=1 and zdoks!=0:
            logger.error("ZDOK " + str(zdoks) + " is not a valid input, aborting...")
         else:
-           self.inl.do_inl(zdoks)
+           if hist:
+               self.inl.do_inl_hist(zdoks, max_error = max_error)
+           else:
+               self.inl.do_inl(zdoks, residuals = self.ogp.residuals.get(zdoks))
            if self.config:
                self.cf.write_inls(zdoks, self.inl.inls)
                self.cf.write_to_file()
 
-    def do_mmcm(self, zdok):
-        "Handles single zdok, or both"
-        if zdok==2:
-            self.do_mmcm(0)
-            self.do_mmcm(1)
+    def do_mmcm(self, zdok, min_eye_width = None, use_cache = False):
+        """
+        Handles single zdok, or both.  Both zdoks are scanned together, see
+        MMCM.calibrate_mmcm_phases, unless use_cache is set.  With
+        min_eye_width, the phase scan stops at the first glitch-free window
+        that wide, see MMCM.calibrate_mmcm_phase.  With use_cache, the phase
+        last found for this roach, bof and clockrate is tried first, see
+        MMCM.calibrate_mmcm_phase_cached; it is only used if bof is set.
+        """
+        if use_cache and not self.bof:
+            logger.warning("no bof given, not using the MMCM phase cache")
+            use_cache = False
+        # the phases may have been changed since the last scan (eg. by a
+        # reprogram), so don't trust the positions kept by the MMCM
+        self.mmcm.reset_phase_pos()
+        if zdok==2 and not use_cache:
+            logger.info("doing MMCM calibration for zdoks 0 and 1")
+            results = self.mmcm.calibrate_mmcm_phases([0, 1], min_eye_width = min_eye_width)
+            for z in [0, 1]:
+                logger.debug("MMCM (Optimal Phase, [Glitches]) for zdok " + str(z) + " : " + str(results[z]))
+                self.write_mmcm_config(z, results[z][0])
+        elif zdok==2:
+            self.do_mmcm(0, min_eye_width, use_cache)
+            self.do_mmcm(1, min_eye_width, use_cache)
         elif zdok==1 or zdok==0:
             logger.info("doing MMCM calibration for zdok " + str(zdok))
             self.mmcm.set_zdok(zdok)
-            opt, g = self.mmcm.calibrate_mmcm_phase()
+            if use_cache:
+                cache = MMCMPhaseCache(self.mmcmCachePath)
+                opt, g = self.mmcm.calibrate_mmcm_phase_cached(cache
+                                                             , self.roach_name
+                                                             , self.bof
+                                                             , self.clockrate
+                                                             , min_eye_width = min_eye_width)
+            else:
+                opt, g = self.mmcm.calibrate_mmcm_phase(min_eye_width = min_eye_width)
             logger.debug("MMCM (Optimal Phase, [Glitches]) for zdok " + str(zdok) + " : " + str((opt, g)))
-            if self.config:
-                self.cf.write_mmcms(self.bof, self.clockrate*1e6, zdok, opt)
-                self.cf.write_to_file()
+            self.write_mmcm_config(zdok, opt)
         else:
             logger.error("ZDOK " + str(zdok) + " is not a valid input")
 
+    def write_mmcm_config(self, zdok, opt):
+        if self.config:
+            self.cf.write_mmcms(self.bof, self.clockrate*1e6, zdok, opt)
+            self.cf.write_to_file()
+
     def gpib_test(self, zdok, freq, ampl, manual=True):
         logger.info("Checking if the synthesizer is connected correctly...")
         #if self.gpib is None:
@@ -403,8 +482,9 @@ class ADCCalibrate:
         else:
             logmsg = "Invalid input for zdok: "+ str(zdok) + " aborting..."
             logger.error(logmsg)
-        m0 = max(np.abs(raw0))
-        m1 = max(np.abs(raw1))
+        # snapshots are int8, where abs(-128) overflows
+        m0 = np.abs(np.asarray(raw0, dtype=int)).max()
+        m1 = np.abs(np.asarray(raw1, dtype=int)).max()
         if m0>=128 or m1>=128:
             logger.warning("Power too high, clipping might be occurring...please check")
 
@@ -660,6 +740,27 @@ class ADCCalibrate:
         else:
             close()
     
+def do_ogp_boards(calibrators, zdoks, freq, n_trails, processes=None):
+    """
+    OGP calibration of the given zdoks (0, 1 or 2 for both) of several
+    boards, one ADCCalibrate each.  The snapshots of all boards and zdoks
+    are fitted by a single pool of worker processes (one per cpu by
+    default).  Returns the per-stage timings, see OGP.do_ogp_parallel.
+    """
+    if zdoks == 2:
+        zdoks = [0, 1]
+    elif zdoks == 0 or zdoks == 1:
+        zdoks = [zdoks]
+    else:
+        logger.error("ZDOK " + str(zdoks) + " is not a valid input, aborting...")
+        return
+    jobs = [(cal, zdok) for cal in calibrators for zdok in zdoks]
+    results, timings = do_ogp_parallel([(cal.ogp, zdok) for cal, zdok in jobs]
+                                      , freq, n_trails, processes)
+    for (cal, zdok), result in zip(jobs, results):
+        cal.write_ogp_config(zdok, result[0][3:])
+    return timings
+
 if __name__ == "__main__":
 
     #AdcCalLoggingFileHandler.timestamp = "_"
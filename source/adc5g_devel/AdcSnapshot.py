@@ -49,6 +49,8 @@ class AdcSnapshot:
         """
         Reads a one-channel snapshot off the given 
         ROACH and returns the time-ordered samples.
+        The samples are an int8 array viewing the received buffer, so no
+        copy is made and the array is read-only.
         """
         
         snap_name = "adcsnap%d" % self.zdok if snap_name is None else snap_name
@@ -56,13 +58,11 @@ class AdcSnapshot:
         # if this is a unit test, return some canned data
         if self.test:
             fn = "testdata/adc_snapshots/snapshot_%s_1" % snap_name
-            return np.genfromtxt(fn, dtype=int)
+            return np.genfromtxt(fn, dtype=int).astype(np.int8)
 
         grab = self.roach.snapshot_get(snap_name, man_trig=man_trig, wait_period=wait_period)
         
-        data = unpack('%ib' %grab['length'], grab['data'])
-    
-        return list(d for d in data) 
+        return np.frombuffer(grab['data'], dtype=np.int8, count=grab['length'])
 
     def get_test_vector(self, snap_names, bitwidth=8, man_trig=True, wait_period=2, iteration = None):
         """
@@ -71,6 +71,9 @@ class AdcSnapshot:
         phase parameter to reduce bit errors.
     
         core_a, core_c, core_b, core_d = get_test_vector(roach, snap_names)
+
+        Each core is returned as a strided uint8 view of the decoded
+        snapshot.
     
         NOTE: This function requires the ADC to be in "test" mode, please use 
         set_spi_control(roach, zdok_n, test=1) before-hand to be in the correct 
@@ -86,8 +89,10 @@ class AdcSnapshot:
                 # get the data from saved files; set up specifially for the unit test
                 i = iteration if iteration is not None else 1
                 fn = "testdata/adc_snapshots/snapshot_%s_%i" % (snap, i) 
-                data = np.genfromtxt(fn, dtype=int)
-            data_bin = list(((p+128)>>1) ^ (p+128) for p in data)
+                data = np.genfromtxt(fn, dtype=int).astype(np.int8)
+            # offset binary, then gray decoding of all samples at once
+            data_bin = np.asarray(data, dtype=np.int8).view(np.uint8) ^ 0x80
+            data_bin ^= data_bin >> 1
             for i in range(cores_per_snap):
                 data_out.append(data_bin[i::cores_per_snap])
         return data_out          
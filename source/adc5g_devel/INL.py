@@ -9,7 +9,7 @@ logger = logging.getLogger('adc5gLogging')
 
 class INL:
 
-    def __init__(self, zdok = 0, dir = None, spi = None, now = None, roach_name = None, test = False):
+    def __init__(self, zdok = 0, dir = None, spi = None, adc = None, now = None, roach_name = None, test = False):
 
         self.dir = dir
         self.test = test
@@ -17,6 +17,7 @@ class INL:
         self.roach_name = roach_name if roach_name is not None else "" 
 
         self.spi = spi
+        self.adc = adc
 
         self.now = datetime.now() if now is None else now
 
@@ -36,6 +37,8 @@ class INL:
         self.zdok = zdok
         if self.spi is not None:
             self.spi.set_zdok(zdok)
+        if self.adc is not None:
+            self.adc.set_zdok(zdok)
         self.set_file_label()    
 
     def set_file_label(self):
@@ -49,6 +52,9 @@ class INL:
     def get_snapshot_res_filename(self):
         return "%s.res" % self.get_snapshot_filename()
 
+    def get_hist_filename(self):
+        return "%s/hist_cores%s" % (self.dir, self.file_label)
+
     def get_inl_meas_filename(self):
         return "%s/inl%s.meas" % (self.dir, self.file_label)
 
@@ -62,6 +68,10 @@ class INL:
         Columns 2-5 contain the inl correction for cores a-d
         """
         c = np.genfromtxt(filename, usecols=(1,2,3,4), unpack=True)
+        if zdok is not None:
+            self.set_zdok(zdok)
+        # the ADC may have lost its registers, write them all
+        self.spi.invalidate_shadow(self.spi.zdok)
         self.set_inls(c)
 
     def set_inls(self, inls, zdok = None):
@@ -70,7 +80,13 @@ class INL:
         for i in range(self.n_cores):
             self.spi.set_inl_registers(self.cores[i], inls[i])
 
-    def do_inl(self, zdok):
+    def do_inl(self, zdok, residuals = None):
+        """
+        INL calibration of a zdok.  The corrections are computed from the
+        given 4x256 array of code residuals (cores a, b, c, d), as kept in
+        memory by OGP, or else from the .res file written by the OGP
+        calibration.
+        """
        
         self.set_zdok(zdok)
 
@@ -89,12 +105,52 @@ class INL:
         #fit_cores.fit_inl(FNAME + ".res")
         # The .res file used here is a 256 by 4 (by cores?) list of residuals.  TBF: who writes this?
         # This is used to compute the INLs, which are stored in inl*.meas
-        self.inls = fit_cores.fit_inl(self.get_snapshot_res_filename(), outname = self.get_inl_meas_filename())
+        if residuals is not None:
+            self.inls = fit_cores.inl_corrections(residuals)
+            fit_cores.save_inl(self.get_inl_meas_filename(), self.inls)
+        else:
+            self.inls = fit_cores.fit_inl(self.get_snapshot_res_filename(), outname = self.get_inl_meas_filename())
 
         #rww_tools.update_inl(fname = 'inl%s.meas'%timestamp)
         self.update_inl() #fname = self.get_inl_meas_filename())
         print('INL done')
 
+    def do_inl_hist(self, zdok, max_error = 0.05, max_snaps = 1000, type = 'sin', save = True, min_fraction = 0.01):
+        """
+        INL calibration of a zdok from a code density test.  Snapshots are
+        captured and added to a histogram of each core until the relative
+        statistical error of every code with at least min_fraction of the
+        median count is below max_error (see HistogramAccumulator.max_error),
+        or max_snaps snapshots were taken.  The histograms are fitted with
+        fit_hist, type 'sin' for a CW input or anything else for noise.
+        If save is set the histograms are also written to a hist_cores file.
+        """
+        self.set_zdok(zdok)
+
+        print('doing histogram inl calibration for zdok ' + str(zdok))
+
+        logger.debug("Clearing INL")
+        self.clear_inl()
+        print("sleeping for 1 secs")
+        time.sleep(1)
+
+        hist = fit_cores.HistogramAccumulator()
+        while hist.nsnaps < max_snaps:
+            hist.add(self.adc.get_adc_snapshot(man_trig=True, wait_period=2))
+            if hist.max_error(min_fraction) < max_error:
+                break
+        logger.info("INL histogram of %d snapshots, max error %f" % (hist.nsnaps, hist.max_error(min_fraction)))
+        if save:
+            hist.save_hist(self.get_hist_filename())
+
+        params, residuals = fit_cores.fit_hist(type = type, hist = hist.hist())
+        logger.debug("INL histogram fit (amplitude, offset): " + str(params.tolist()))
+        self.inls = fit_cores.inl_corrections(residuals)
+        fit_cores.save_inl(self.get_inl_meas_filename(), self.inls)
+
+        self.update_inl()
+        print('INL done')
+
     def clear_inl(self):
         "Clear the INL registers on the ADC"
         offs = [0.0]*17
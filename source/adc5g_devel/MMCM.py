@@ -5,10 +5,39 @@ import numpy as np
 import time
 
 from SPI import OPB_CONTROLLER
+from ..helper_functions import JsonCache, get_bof_hash
 
 
 logger = logging.getLogger('adc5gLogging')
 
+class MMCMPhaseCache(JsonCache):
+
+    """
+    On-disk (JSON) cache of the optimal MMCM phase and glitch profile of
+    each (board, bof, clockrate, zdok).  The optimal phase of a given
+    board and bitstream is very stable, so it can be tried first on the
+    next bring-up instead of scanning all the phases again.  bof has to
+    identify the bitstream, see helper_functions.get_bof_hash.
+    """
+
+    def get_key(self, board, bof, clockrate, zdok):
+        return "%s|%s|%s|%d" % (board, get_bof_hash(bof), float(clockrate), zdok)
+
+    def get(self, board, bof, clockrate, zdok):
+        "Returns the cached entry, a dictionary with phase and glitches, or None."
+        return self.get_record(self.get_key(board, bof, clockrate, zdok))
+
+    def put(self, board, bof, clockrate, zdok, phase, glitches):
+        "Store a calibration result and write the cache to disk."
+        self.put_record(self.get_key(board, bof, clockrate, zdok), {
+            'phase'    : int(phase)
+          , 'glitches' : [int(g) for g in glitches]
+          , 'time'     : time.strftime('%Y-%m-%d-%H%M%S')
+          })
+
+    def remove(self, board, bof, clockrate, zdok):
+        self.remove_record(self.get_key(board, bof, clockrate, zdok))
+
 class MMCM:
 
     def __init__(self, zdok = 0, spi = None, adc = None,  test = False, file_label = None):
@@ -18,6 +47,9 @@ class MMCM:
         self.spi = spi
         #self.file_label = file_label
 
+        # MMCM phase of each zdok, counted from the start of the last scan
+        self.phase_pos = {}
+
         #self.roach_original_control = {'0':None, '1':None}
 
         self.set_zdok(zdok)
@@ -28,72 +60,196 @@ class MMCM:
         self.spi.set_zdok(zdok)
         self.adc.set_zdok(zdok)
 
+    def reset_phase_pos(self, zdoks = None):
+        """
+        Forget the MMCM phase of the given zdoks (of all by default), eg.
+        after a reprogram or a direct SPI.inc_mmcm_phase, so the next move
+        goes back to the start first.
+        """
+        if zdoks is None:
+            self.phase_pos = {}
+        else:
+            for zdok in zdoks:
+                self.phase_pos.pop(zdok, None)
+
     def get_snap_name(self, zdok):
         return "adcsnap%d" % zdok
 
-    def calibrate_mmcm_phase(self, bitwidth=8, man_trig=True, wait_period=2, ps_range=56, set_phase = True):
+    def calibrate_mmcm_phase(self, bitwidth=8, man_trig=True, wait_period=2, ps_range=56, set_phase = True, min_eye_width = None):
         """
-        This function steps through all 56 steps of the MMCM clk-to-out 
+        This function steps through the 56 steps of the MMCM clk-to-out 
         phase and finds total number of glitchss in the test vector ramp 
         per core. It then finds the least glitchy phase step and sets it.
-        """
 
-        snap_names = [self.snap_name] #["adcsnap%d" % self.zdok]
-        self.spi.set_test_mode(counter=True)
-        logger.debug("current spi control: " + str(self.spi.roach_original_control[str(self.zdok)]))
+        If min_eye_width is given, the scan stops as soon as a window of
+        at least that many glitch-free steps has been bracketed, so the
+        time taken scales with the eye position and width rather than
+        with the full phase range.  In that case glitches_per_ps only
+        covers the steps that were scanned.
+        """
+        return self.calibrate_mmcm_phases([self.zdok]
+                                        , bitwidth = bitwidth
+                                        , man_trig = man_trig
+                                        , wait_period = wait_period
+                                        , ps_range = ps_range
+                                        , set_phase = set_phase
+                                        , min_eye_width = min_eye_width)[self.zdok]
+
+    def calibrate_mmcm_phases(self, zdoks, bitwidth=8, man_trig=True, wait_period=2, ps_range=56, set_phase = True, min_eye_width = None):
+        """
+        Calibrates the MMCM phase of several zdoks at once, as in
+        calibrate_mmcm_phase.  The phase controllers of all zdoks are
+        stepped together, with a single write per step, and a ramp of each
+        zdok is taken at every step.  The optimal phase of each zdok is
+        chosen independently.  Returns a dictionary with (optimal_ps,
+        glitches_per_ps) for each zdok.
+        """
+        orig_zdok = self.zdok
+        for zdok in zdoks:
+            self.set_zdok(zdok)
+            self.spi.set_test_mode(counter=True)
+            logger.debug("current spi control: " + str(self.spi.roach_original_control[str(zdok)]))
         self.spi.sync_adc()
 
-        glitches_per_ps = []
+        glitches_per_ps = dict((zdok, []) for zdok in zdoks)
 
-        #start off by decrementing the mmcm right back to the beginning
-        logger.debug("decrementing mmcm to start")
-        for ps in range(ps_range):
-            self.spi.inc_mmcm_phase(inc=0)
+        #start off by going right back to the beginning
+        logger.debug("moving mmcm to start")
+        self.reset_phase_pos(zdoks)
+        self.move_to_phases(dict((zdok, 0) for zdok in zdoks), ps_range)
 
         # then step back up throught the phases counting glitches
+        scanning = list(zdoks)
         for ps in range(ps_range):
-            glitches = self.get_total_glitches(snap_names, man_trig, wait_period, ps)
-            glitches_per_ps.append(glitches)
-            self.spi.inc_mmcm_phase()
+            for zdok in scanning:
+                glitches = self.get_total_glitches([self.get_snap_name(zdok)], man_trig, wait_period, ps)
+                glitches_per_ps[zdok].append(glitches)
+            if min_eye_width is not None:
+                for zdok in scanning:
+                    if self.eye_bracketed(glitches_per_ps[zdok], min_eye_width):
+                        logger.debug("zdok %d: eye of %d steps found after %d steps" % (zdok, min_eye_width, ps + 1))
+                scanning = [zdok for zdok in scanning
+                            if not self.eye_bracketed(glitches_per_ps[zdok], min_eye_width)]
+                if len(scanning) == 0:
+                    break
+            if ps + 1 < ps_range:
+                self.move_to_phases(dict((zdok, ps + 1) for zdok in scanning))
 
         # now that you've gathered that data, use it to find
-        # the optimal phase for the MMCM
-        optimal_ps = self.find_optimal_phase(glitches_per_ps)
-        if optimal_ps is not None and set_phase:
+        # the optimal phase for the MMCM of each zdok
+        optimal_ps = dict((zdok, self.find_optimal_phase(glitches_per_ps[zdok])) for zdok in zdoks)
+        found = dict((zdok, ps) for zdok, ps in optimal_ps.items() if ps is not None)
+        if set_phase:
             # if you found something, set the hardware!
-            # first, get back to the start
-            for ps in range(ps_range):
-                self.spi.inc_mmcm_phase(inc=0)
-            # then step up to the optimal phase    
-            for ps in range(optimal_ps):
-                self.spi.inc_mmcm_phase()
+            self.move_to_phases(found)
             # now just double check that there's no glitches here    
-            glitches = self.get_total_glitches(snap_names, man_trig, wait_period, ps)
-            if glitches != 0:
-                tmsg = "MMCM Optimal Phase of %d should not produce any glitches of %d" % (optimal_ps, glitches)
-                logger.info(tmsg);
-                raise Exception(tmsg)
+            for zdok, ps in found.items():
+                glitches = self.get_total_glitches([self.get_snap_name(zdok)], man_trig, wait_period, ps)
+                if glitches != 0:
+                    tmsg = "MMCM Optimal Phase of %d should not produce any glitches of %d" % (ps, glitches)
+                    logger.info(tmsg);
+                    raise Exception(tmsg)
 
         # get us back to our original mode
+        for zdok in zdoks:
+            self.set_zdok(zdok)
+            self.spi.unset_test_mode()
+        self.set_zdok(orig_zdok)
+
+        return dict((zdok, (optimal_ps[zdok], glitches_per_ps[zdok])) for zdok in zdoks)
+
+    def calibrate_mmcm_phase_cached(self, cache, board, bof, clockrate, man_trig=True, wait_period=2, ps_range=56, min_eye_width = None):
+        """
+        Like calibrate_mmcm_phase, but first tries the phase found for this
+        board, bof, clockrate and zdok in the MMCMPhaseCache cache.  The
+        cached phase is kept if a ramp snapshot there and at the phases one
+        step either side is free of glitches; otherwise the full scan is done
+        and the cache updated.  bof has to identify the bitstream, see
+        MMCMPhaseCache.get_bof_hash.
+        """
+        entry = cache.get(board, bof, clockrate, self.zdok)
+        if entry is not None:
+            glitches = self.check_phase(entry['phase'], man_trig, wait_period, ps_range, margin=1)
+            if glitches == 0:
+                logger.info("using cached MMCM phase %d for zdok %d" % (entry['phase'], self.zdok))
+                return entry['phase'], entry['glitches']
+            logger.info("cached MMCM phase %d for zdok %d gives %d glitches, scanning" % (entry['phase'], self.zdok, glitches))
+
+        optimal_ps, glitches_per_ps = self.calibrate_mmcm_phase(man_trig=man_trig
+                                                               , wait_period=wait_period
+                                                               , ps_range=ps_range
+                                                               , min_eye_width=min_eye_width)
+        if optimal_ps is not None:
+            cache.put(board, bof, clockrate, self.zdok, optimal_ps, glitches_per_ps)
+        return optimal_ps, glitches_per_ps
+
+    def check_phase(self, ps, man_trig=True, wait_period=2, ps_range=56, margin=0):
+        """
+        Go back to the start of the phase range and return the glitches of
+        one ramp snapshot at each phase from ps - margin to ps + margin
+        (within the range), summed.  The MMCM is left at phase ps.
+        """
+        self.spi.set_test_mode(counter=True)
+        self.spi.sync_adc()
+        self.reset_phase_pos([self.zdok])
+        glitches = 0
+        for p in range(max(ps - margin, 0), min(ps + margin, ps_range - 1) + 1):
+            self.move_to_phase(p, ps_range)
+            glitches += self.get_total_glitches([self.snap_name], man_trig, wait_period, p)
+        self.move_to_phase(ps, ps_range)
         self.spi.unset_test_mode()
+        return glitches
 
-        return optimal_ps, glitches_per_ps        
+    def move_to_phase(self, ps, ps_range = 56):
+        """
+        Step the MMCM phase of the current zdok to ps, counted from the
+        start of the scan.  See move_to_phases.
+        """
+        self.move_to_phases({self.zdok: ps}, ps_range)
 
+    def move_to_phases(self, phases, ps_range = 56):
+        """
+        Step the MMCM phase of each zdok in the dictionary phases to its
+        value, counted from the start of the scan.  The position is tracked
+        per zdok so this takes the shortest path; if it is unknown, the
+        phase is first decremented ps_range times to get back to the start.
+        All zdoks are stepped together.
+        """
+        unknown = [zdok for zdok in phases if self.phase_pos.get(zdok) is None]
+        if len(unknown) > 0:
+            for i in range(ps_range):
+                self.spi.inc_mmcm_phases(dict((zdok, 0) for zdok in unknown))
+            for zdok in unknown:
+                self.phase_pos[zdok] = 0
+        steps = dict((zdok, ps - self.phase_pos[zdok]) for zdok, ps in phases.items())
+        for i in range(max([abs(s) for s in steps.values()] + [0])):
+            self.spi.inc_mmcm_phases(dict((zdok, int(s > 0)) for zdok, s in steps.items() if abs(s) > i))
+        self.phase_pos.update(phases)
+
+    def eye_bracketed(self, glitches_per_ps, min_eye_width):
+        """
+        True if the glitches scanned so far contain a closed window, ending
+        with a glitchy step, of at least min_eye_width glitch-free steps.
+        """
+        gl = np.asarray(glitches_per_ps)
+        if len(gl) < 2 or gl[-1] == 0:
+            return False
+        return max([end - start + 1 for start, end in self.find_false_sequences(gl != 0)] + [0]) >= min_eye_width
    
     def get_total_glitches(self, snap_names, man_trig, wait_period, iteration):
 
         cores = self.adc.get_test_vector(snap_names, man_trig=man_trig, wait_period=wait_period, iteration=iteration)
-        return sum([self.count_glitches(core, 8) for core in cores]) 
+        return self.count_glitches(np.vstack(cores), 8)
 
     def count_glitches(self, core, bitwidth=8):
-        "Counts number of times the expected result is not found in the ramp."
-        ramp_max = 2**bitwidth - 1
-        glitches = 0
-        for i in range(len(core)-1):
-            diff = core[i+1] - core[i]
-            if (diff!=1) and (diff!=-ramp_max):
-                glitches += 1
-        return glitches        
+        """
+        Counts number of times the expected result is not found in the ramp.
+        core may also be a 2-D array with one core per row, in which case
+        the glitches of all the cores are counted at once.
+        """
+        # the ramp steps by one, wrapping around at 2**bitwidth
+        diff = np.diff(np.asarray(core, dtype=int), axis=-1) % 2**bitwidth
+        return int(np.count_nonzero(diff != 1))
 
     def find_optimal_phase_old(self, glitches_per_ps):    
         "Historical method: has bugs concerning edge cases"
@@ -143,7 +299,7 @@ class MMCM:
         if len(indx) > 0:
             # if there is more then one sequence of zero glitches
             # with the largest length, arbitrarily choose the first
-            rgIndx = indx[0] if len(indx[0]) == 1 else indx[0][0]
+            rgIndx = indx[0][0]
             range = sqs[rgIndx]
             # choose the midpoint
             optimal_phase = range[0] + int((range[1] - range[0])/2) 
@@ -1,5 +1,6 @@
 import time
 import logging
+import multiprocessing
 import numpy as np
 from datetime import datetime
 
@@ -34,6 +35,11 @@ class OGP:
         #self.samp_freq = 2*self.clockrate
         self.ogps = []
 
+        # running averages of the snapshot fits
+        self.acc = fit_cores.OgpInlAccumulator()
+        # code residuals (raw INL data) of the last calibration of each zdok
+        self.residuals = {}
+
     def set_clockrate(self, clockrate):
         self.clockrate = clockrate
         self.samp_freq = self.clockrate * 2
@@ -64,6 +70,8 @@ class OGP:
         """
         if zdok is not None:
             self.set_zdok(zdok)
+        # the ADC may have lost its registers, write them all
+        self.spi.invalidate_shadow(self.spi.zdok)
         self.spi.set_control() 
         t = np.genfromtxt(filename)
         # split these up by type and channel
@@ -90,7 +98,15 @@ class OGP:
         for i in range(self.n_cores):
             self.spi.set_phase(self.cores[i], values[i])
 
-    def do_ogp(self, zdok, test_freq=18.3105, repeat=10): 
+    def do_ogp(self, zdok, test_freq=18.3105, repeat=10, processes=None): 
+        """
+        OGP calibration of a zdok.  If processes is given, the snapshots
+        are fitted by a pool of that many worker processes while the next
+        ones are captured, see do_ogp_parallel.  Returns the fitted ogp
+        values and the average sinad.
+        """
+        if processes is not None:
+            return do_ogp_parallel([(self, zdok)], test_freq, repeat, processes)[0][0]
 
         self.set_zdok(zdok)
 
@@ -118,6 +134,12 @@ class OGP:
         #ogp = np.zeros(16)
         #sinad = np.zeros(10)
         
+        self.residuals[zdok] = self.acc.residuals()
+        self.set_ogp(ogp, sinad)
+        return ogp, sinad
+
+    def set_ogp(self, ogp, sinad):
+        "Save the fitted ogp values to file and load them into the ADC."
         self.ogps = ogp[3:]
         print('OGP:' + str(self.ogps))
         print('SINAD:' + str(sinad))
@@ -137,7 +159,7 @@ class OGP:
             self.spi.set_offset(core, 0)
             self.spi.set_phase(core, 0)
 
-    def do_snap(self, freq=0, fname="t", repeat = 1, donot_clear=False):
+    def do_snap(self, freq=0, fname="t", repeat = 1, donot_clear=False, save=True):
         """
         Takes a snapshot and uses fit_cores to fit a sine function to each
         core separately assuming a CW signal is connected to the input.  The
@@ -147,31 +169,119 @@ class OGP:
         The parameters are:
           fr   The frequency of the signal generator.  It will default to the last
                frequency set by set_freq()
-          name the name of the file into which the snapshot is written.  5 other
-               files are written.  Name.c1 .. name.c4 contain themeasurements from
-           cores a, b, c and d.  Note that data is taken from cores in the order
-           a, c, b, d.  A line is appended to the file name.fit containing
-           signal freq, average zero, average amplitude followed by triplets
-           of zero, amplitude and phase differences for cores a, b, c and d
-      
-          rpt  The number of repeats.  Defaults to 1.  The c1 .. c4 files mentioned
-               above are overwritten with each repeat, but new rows of data are added
-           to the .fit file for each pass.
+          name the base name of the files written after the last repeat.
+               name.npz contains the last snapshot and its fits, name.res the
+               raw INL data and a line is appended to name.ogp containing
+               signal freq, average zero, average amplitude followed by triplets
+               of zero, amplitude and phase differences for cores a, b, c and d.
+               Note that data is taken from cores in the order a, c, b, d.
+          rpt  The number of repeats.  Defaults to 1.  Snapshots are fitted in
+               memory, nothing is written until the last repeat.
+          save If False, don't write any file at all.
         """
         avg_pwr_sinad = 0
         for i in range(repeat):
-          # We skip this interaction with hardware if this is a test, use 
-          if not self.test:
-              snap = self.adc.get_adc_snapshot(man_trig=True, wait_period=2)
-              np.savetxt(fname, snap,fmt='%d')
-              fname2 = fname
-          else:
-              # if we're testing, use the intermediate files
-              fname2 = "%s.%d" % (fname, i)
-          ogp, pwr_sinad = fit_cores.fit_snap(freq
-                                            , self.samp_freq
-                                            , fname2
-                                            , clear_avgs = i == 0 and not donot_clear
-                                            , prnt = i == repeat-1)
+          snap = self.get_snap(fname, i)
+          ogp, pwr_sinad = fit_cores.fit_snap_data(snap
+                                                 , freq
+                                                 , self.samp_freq
+                                                 , clear_avgs = i == 0 and not donot_clear
+                                                 , prnt = i == repeat-1
+                                                 , fname = fname if save else None
+                                                 , acc = self.acc)
           avg_pwr_sinad += pwr_sinad
         return ogp, avg_pwr_sinad/repeat        
+
+    def get_snap(self, fname, i):
+        "Returns the i-th snapshot of a series as an int8 array."
+        # We skip this interaction with hardware if this is a test, use 
+        if not self.test:
+            snap = self.adc.get_adc_snapshot(man_trig=True, wait_period=2)
+        else:
+            # if we're testing, use the intermediate files
+            snap = np.loadtxt("%s.%d" % (fname, i), dtype=int)
+        return np.asarray(snap, dtype=np.int8)
+
+def do_ogp_parallel(ogps, test_freq=18.3105, repeat=10, processes=None):
+    """
+    OGP calibration of several zdoks, possibly of different boards, at once.
+    ogps is a list of (OGP, zdok) pairs.  Snapshots are captured here, since
+    they go through the katcp connection of each board, and handed to a
+    pool of processes (by default one per cpu) that fits them while the
+    next snapshots are captured.  The partial fits of each pair are merged,
+    and the result is saved and loaded into the ADC as in OGP.do_ogp: the
+    .ogp line, the .npz of the last snapshot (fitted again here) and the
+    .res are written as by do_snap.
+
+    Returns the list of (ogp, sinad) tuples (same order as ogps) and a dictionary
+    with the time spent on each stage: capturing snapshots, fitting (the
+    sum over all workers), waiting for the last fits, loading the results
+    and the total wall-clock time.
+    """
+    timings = {'capture': 0.0, 'fit': 0.0, 'wait': 0.0, 'load': 0.0, 'total': 0.0}
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        print('doing parallel ogp calibration for zdoks %s' % [zdok for ogp, zdok in ogps])
+        print('test_freq: ' + str(test_freq) + '  repeat: ' + str(repeat))
+        logger.debug("Clearing OGP")
+        for ogp, zdok in ogps:
+            ogp.set_zdok(zdok)
+            ogp.clear_ogp()
+        print("sleeping for 1 secs")
+        time.sleep(1)
+
+        jobs = [[] for pair in ogps]
+        last_snaps = [None for pair in ogps]
+        for i in range(repeat):
+            for n, (ogp, zdok) in enumerate(ogps):
+                t0 = time.time()
+                ogp.set_zdok(zdok)
+                snap = ogp.get_snap(ogp.get_snapshot_filename(), i)
+                last_snaps[n] = snap
+                timings['capture'] += time.time() - t0
+                jobs[n].append(pool.apply_async(fit_cores.fit_snap_partial
+                                               , ((snap, test_freq, ogp.samp_freq),)))
+
+        t0 = time.time()
+        results = []
+        for n, (ogp, zdok) in enumerate(ogps):
+            acc = fit_cores.OgpInlAccumulator()
+            sinad = 0
+            for job in jobs[n]:
+                part, pwr_sinad, fit_time = job.get()
+                acc.merge(part)
+                sinad += pwr_sinad
+                timings['fit'] += fit_time
+            results.append((acc, sinad/repeat))
+        timings['wait'] = time.time() - t0
+    except:
+        # don't wait for the fits still queued
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    t0 = time.time()
+    ogp_results = []
+    for (ogp, zdok), (acc, sinad), snap in zip(ogps, results, last_snaps):
+        ogp.set_zdok(zdok)
+        ogp.acc = acc
+        ogp.residuals[zdok] = acc.residuals()
+        fname = ogp.get_snapshot_filename()
+        if acc.result_cnt > 1:
+            fit_cores.save_ogp(fname, acc, test_freq)
+        plsq, fit, core_fit = fit_cores.snap_fits(snap, test_freq, ogp.samp_freq)
+        fit_cores.save_fit(fname, snap, fit, core_fit)
+        acc.code_residuals.save_res(fname + '.res')
+        ogp.set_ogp(acc.ogp(test_freq), sinad)
+        ogp_results.append((acc.ogp(test_freq), sinad))
+    timings['load'] = time.time() - t0
+    timings['total'] = time.time() - start
+
+    logger.info("parallel ogp timings (s): " + str(timings))
+    print("timings (s): " + ", ".join("%s %.2f" % (k, timings[k])
+        for k in ['capture', 'fit', 'wait', 'load', 'total']))
+    return ogp_results, timings
@@ -1,6 +1,8 @@
+import time
 import numpy as np
 from struct import pack, unpack
 from math import floor
+from collections import deque
 
 CONTROL_REG_ADDR = 0x01 + 0x80
 CHANSEL_REG_ADDR = 0x0f + 0x80
@@ -10,9 +12,64 @@ EXTPHAS_REG_ADDR = 0x24 + 0x80
 CALCTRL_REG_ADDR = 0x10 + 0x80
 FIRST_EXTINL_REG_ADDR = 0x30 + 0x80
 
+# registers holding a value per channel, selected by CHANSEL
+BANKED_REG_ADDRS = [EXTOFFS_REG_ADDR, EXTGAIN_REG_ADDR, EXTPHAS_REG_ADDR] + \
+                   range(FIRST_EXTINL_REG_ADDR, FIRST_EXTINL_REG_ADDR+6)
+
+# CALCTRL value loading the offset, gain, phase and INL of a channel at once
+CALCTRL_LOAD_ALL = 2 + (2<<2) + (2<<4) + (2<<6)
+
+# INL encoding: each of the 17 levels has a 4 bit code, split in two bit
+# fields of registers r (high bits) and r+3 (low bits).  Levels 0-3 are in
+# bits 8-14 of register 2, 4-11 in bits 0-14 of register 1 and 12-16 in
+# bits 0-8 of register 0.
+INL_LEVEL_REG = np.array([2]*4 + [1]*8 + [0]*5)
+INL_LEVEL_BIT = np.array(range(8, 16, 2) + range(0, 16, 2) + range(0, 10, 2))
+# one hot (level, register) matrix to sum the fields of each register
+INL_LEVEL_REG_MATRIX = (INL_LEVEL_REG[:, np.newaxis] == np.arange(3)).astype('int32')
+# code of each offset from +4 to -4 steps of 0.15 lsb, and back
+INL_STEP_TO_BITS = np.array([5,4,6,1,0,2,9,8,10])
+INL_BITS_TO_STEP = np.array([0,1,-1,0,3,4,2,0,-3,-2,-4,0,0,0,0,0])
+INL_STEP = 0.15
+
+def quantize_inl(offs):
+    """
+    Round INL offsets (in lsb) to those the hardware can set: multiples of
+    0.15 between -0.6 and +0.6.  regs_to_inl(inl_to_regs(offs)) gives the
+    same result, which can be used to check the encoding.
+    """
+    return INL_STEP * np.clip(np.floor(0.5 + np.asarray(offs)/INL_STEP), -4, 4)
+
+def inl_to_regs(offs):
+    """
+    Encode INL offsets, an array of (..., 17) floats (e.g. 4x17 for the four
+    cores), into the values of the six INL registers, an array of (..., 6).
+    """
+    steps = np.clip(np.floor(0.5 + np.asarray(offs)/INL_STEP), -4, 4).astype(int)
+    bits = INL_STEP_TO_BITS[4 - steps]
+    # the fields don't overlap, so summing them is the same as or-ing
+    high = ((bits >> 2) & 3) << INL_LEVEL_BIT
+    low = (bits & 3) << INL_LEVEL_BIT
+    return np.concatenate((np.dot(high, INL_LEVEL_REG_MATRIX)
+                         , np.dot(low, INL_LEVEL_REG_MATRIX)), axis=-1).astype('int32')
+
+def regs_to_inl(regs):
+    """
+    Decode the values of the six INL registers, an array of (..., 6), into
+    INL offsets, an array of (..., 17).  Invalid codes decode as 0.
+    """
+    regs = np.asarray(regs).astype(int)
+    bits = (0xc & ((regs[..., INL_LEVEL_REG] >> INL_LEVEL_BIT) << 2)) \
+         | (3 & (regs[..., INL_LEVEL_REG + 3] >> INL_LEVEL_BIT))
+    return INL_STEP * INL_BITS_TO_STEP[bits]
+
 OPB_CONTROLLER = 'adc5g_controller'
 OPB_DATA_FMT = '>H2B'
 
+# transaction log entries as saved by SPI.save_log; kind is 'w' for writes
+# and 'r' for register reads, data the 32 bit word written or read
+LOG_DTYPE = [('time', 'f8'), ('kind', 'S1'), ('offset', 'u4'), ('data', 'u4'), ('latency', 'f8')]
+
 class SPI:
 
     """
@@ -22,9 +79,22 @@ class SPI:
     systems, sensors, and SD cards.
 
     This class is responsible for writing .... TBF
+
+    The last value written to each register of each zdok is kept in
+    shadow registers.  Unless use_shadow is False, writes that would not
+    change anything are skipped and registers written since the shadow was
+    last cleared are read from it; saved_transactions counts the SPI
+    transactions avoided.  The shadow of a zdok is cleared by sync_adc and
+    the test mode changes, and should be cleared with invalidate_shadow
+    whenever the ADC may have been reset or written to by anything else
+    (ADCCalibrate.load_calibrations and the OGP and INL load_from_file do).
+
+    The last log_size transactions with the roach are kept in a ring
+    buffer, self.log, as (time, kind, offset, data, latency) tuples, see
+    log_transaction.  A log_size of 0 disables the log.
     """
 
-    def __init__(self, zdok = 0, roach = None, test = False):
+    def __init__(self, zdok = 0, roach = None, test = False, use_shadow = True, log_size = 1000):
 
 
         if roach is None and not test:
@@ -50,14 +120,56 @@ class SPI:
   
         self.roach_original_control = {'0':None, '1':None}
 
-        # for testing
-        self.regs = []
-        self.writes = []
+        self.use_shadow = use_shadow
+        self.saved_transactions = 0
+        self.invalidate_shadow()
+
+        # transaction log, for testing and replay
+        self.log = deque(maxlen = log_size) if log_size else None
 
     def set_zdok(self, zdok):
         assert zdok == 0 or zdok == 1
         self.zdok = zdok
 
+    def invalidate_shadow(self, zdok = None):
+        "Forget the shadow registers of the given zdok, or of both by default."
+        if zdok is None:
+            self.shadow = {0: {}, 1: {}}
+        else:
+            self.shadow[zdok] = {}
+
+    def get_shadow_key(self, reg_addr):
+        """
+        The key of a register in the shadow of the current zdok: its address,
+        or (channel, address) for registers banked by CHANSEL.  Returns None
+        for registers that can't be shadowed: CALCTRL, which is a command,
+        and banked registers when the channel is unknown.
+        """
+        reg_addr = reg_addr | 0x80
+        if reg_addr == CALCTRL_REG_ADDR:
+            return None
+        if reg_addr in BANKED_REG_ADDRS:
+            chan = self.shadow[self.zdok].get(CHANSEL_REG_ADDR)
+            return None if chan is None else (chan, reg_addr)
+        return reg_addr
+
+    def in_shadow(self, reg_addr, reg_val = None):
+        """
+        True if the register is known in the shadow registers (and holds
+        reg_val, if given).
+        """
+        if not self.use_shadow:
+            return False
+        key = self.get_shadow_key(reg_addr)
+        if key not in self.shadow[self.zdok]:
+            return False
+        return reg_val is None or self.shadow[self.zdok][key] == int(reg_val)
+
+    def update_shadow(self, reg_addr, reg_val):
+        key = self.get_shadow_key(reg_addr)
+        if key is not None:
+            self.shadow[self.zdok][key] = int(reg_val)
+
     def get_zdok_offset(self):
         """
         The different zdok's must be written at different locations in the 
@@ -90,6 +202,10 @@ class SPI:
     def set_spi_value(self, chn, value, scale, ext_reg_addr, calctrl_reg_addr):
         "Worker function for setting offset/gain/phase values to a channel on the ADC over SPI."
         reg_val = self.scale_value(value, scale)
+        if self.use_shadow and self.shadow[self.zdok].get((chn, ext_reg_addr)) == int(reg_val):
+            # this value is already loaded in the channel
+            self.saved_transactions += 3
+            return
         self.set_spi_register(CHANSEL_REG_ADDR, chn)
         self.set_spi_register(ext_reg_addr, reg_val)
         self.set_spi_register(CALCTRL_REG_ADDR, calctrl_reg_addr)
@@ -138,36 +254,92 @@ class SPI:
 
     def set_spi_register(self, reg_addr, reg_val):
         """
-        Sets the value of an ADC's register over SPI
+        Sets the value of an ADC's register over SPI.  The write is skipped
+        if the shadow shows the register already has this value; banked
+        registers are only skipped as a whole, see set_spi_value.
         """
-        #if self.test:
-        # record what our values are
-        self.regs.append((reg_addr, reg_val))
+        if (reg_addr | 0x80) not in BANKED_REG_ADDRS and self.in_shadow(reg_addr, reg_val):
+            self.saved_transactions += 1
+            return
 
         spi_data = pack(OPB_DATA_FMT, reg_val, reg_addr, 0x01)
 
         zdok_offset = self.get_zdok_offset()
 
         self.blindwrite(spi_data, zdok_offset)
+        self.update_shadow(reg_addr, reg_val)
 
     def blindwrite(self, data, offset):
 
-        # record what we do
-        self.writes.append((offset, data))
-
+        start = time.time()
         if not self.test:
             # actually send it to the roach
             self.roach.blindwrite(OPB_CONTROLLER, data, offset=offset)
+        # record what we do
+        self.log_transaction('w', offset, data, start)
+
+    def log_transaction(self, kind, offset, data, start):
+        """
+        Add a transaction that started at time start to the log: kind 'w'
+        for a write of data at offset, 'r' for a register read that
+        returned data.
+        """
+        if self.log is not None:
+            self.log.append((start, kind, offset, data, time.time() - start))
+
+    def replay_log(self, log = None, skip_mmcm = True, force = False):
+        """
+        Write again, in order, the writes of a transaction log: by default
+        this SPI's own log, or eg. one read by load_log.  This restores the
+        ADC registers recorded by the log, eg. after a reprogram.  Writes at
+        offset 0 (MMCM phase steps and sync pulses) are relative, so they
+        are skipped unless skip_mmcm is False.  The replayed writes are not
+        logged again.  As a full ring has lost its oldest writes and can't
+        restore the whole state, replaying it raises a ValueError unless
+        force is set.  Returns the number of writes.
+        """
+        if log is None:
+            if not force and self.log is not None and len(self.log) == self.log.maxlen:
+                raise ValueError("The transaction log has overflowed, it can't restore the ADC state.")
+            log = self.log if self.log is not None else []
+        log = list(log)
+        n = 0
+        for start, kind, offset, data, latency in log:
+            if kind != 'w' or (skip_mmcm and offset == 0):
+                continue
+            if not self.test:
+                self.roach.blindwrite(OPB_CONTROLLER, data, offset=offset)
+            n += 1
+        self.invalidate_shadow()
+        return n
+
+    def save_log(self, filename):
+        "Save the transaction log to a binary (.npy) file."
+        log = self.log if self.log is not None else []
+        np.save(filename, np.array([(start, kind, offset, unpack('>I', data)[0], latency)
+                                    for start, kind, offset, data, latency in log]
+                                 , dtype = LOG_DTYPE))
+
+    def load_log(self, filename):
+        "Read a transaction log saved by save_log, for replay_log."
+        return [(e['time'], e['kind'], int(e['offset']), pack('>I', e['data']), e['latency'])
+                for e in np.load(filename)]
 
     def get_spi_register(self, reg_addr):
         """
-        Gets the value of an ADC's register over SPI
+        Gets the value of an ADC's register over SPI, or from the shadow
+        registers if it was written since they were last cleared.
         """
+        if self.in_shadow(reg_addr):
+            self.saved_transactions += 1
+            return self.shadow[self.zdok][self.get_shadow_key(reg_addr)]
         spi_data = pack(OPB_DATA_FMT, 0x0, reg_addr, 0x01)
         offset = self.get_zdok_offset()
         if not self.test:
+            start = time.time()
             self.roach.blindwrite(OPB_CONTROLLER, spi_data, offset=offset) #0x4+self.zdok_n*0x4)
             raw = self.roach.read(OPB_CONTROLLER, 0x4, offset=offset) #0x4+zdok_n*0x4)
+            self.log_transaction('r', offset, raw, start)
             reg_val, old_reg_addr, config_done = unpack(OPB_DATA_FMT, raw)
         else:
             reg_val = 1 # TBF?
@@ -178,27 +350,8 @@ class SPI:
             return reg_val
 
     def inl_values_to_reg_values(self, offs):
-        level_to_bits = np.array([5,4,6,1,0,2,9,8,10])
-    
-        # create a array of 6 ints to hold the values for the registers
-        regs = np.zeros((6), dtype='int32')
-        r = 2	# r is the relative register number.  R = 2 for 0x32 and 0x35
-        regbit = 8 #  regbit is the bit in the register
-        for level in range(17):	# n is the bit number in the incoming bits aray
-            n = int(floor(0.5 + offs[level]/0.15))
-            if n > 4:
-                n = 4
-            if n < -4:
-                n = -4
-    	    i = level_to_bits[4-n]
-            regs[r] |= ((i >>2) & 3) << regbit
-            regs[r + 3] |= (i & 3)<< regbit
-            if regbit == 14:
-                r -= 1
-                regbit = 0
-            else:
-                regbit += 2
-        return regs
+        "The six INL register values for 17 INL offsets, see inl_to_regs."
+        return inl_to_regs(offs)
 
     def set_inl_registers(self, chan, offs):
         """
@@ -219,6 +372,11 @@ class SPI:
          specifically section 8.7.19 through 8.8, for more details.
         """
         regs = self.inl_values_to_reg_values(offs)
+        if self.use_shadow and all([self.shadow[self.zdok].get((chan, FIRST_EXTINL_REG_ADDR+n)) == regs[n]
+                                    for n in range(6)]):
+            # these values are already loaded in the channel
+            self.saved_transactions += 8
+            return
         self.set_spi_register(CHANSEL_REG_ADDR, chan)
         for n in range(6):
     	    reg_val = float(regs[n])
@@ -229,25 +387,66 @@ class SPI:
         regs = np.zeros((6), dtype='int32')
         self.set_spi_register(CHANSEL_REG_ADDR, chan)
         for n in range(6):
-            if not self.test:
+            if not self.test or self.in_shadow(FIRST_EXTINL_REG_ADDR+n):
                 regs[n] = self.get_spi_register(FIRST_EXTINL_REG_ADDR-0x80+n)
         return self.inl_regs_to_inl_vals(regs)
 
 
     def inl_regs_to_inl_vals(self, regs):
-        bits_to_off = np.array([0,1,-1,0,3,4,2,0,-3,-2,-4])
-        offs = np.zeros((17), dtype = float)
-        r = 2	# r is the relative register number.  R = 2 for 0x32 and 0x35
-        regbit = 8	#  regbit is the bit in the register
-        for level in range(17):	# n is the bit number in the incoming bits aray
-            bits = 0xc & ((regs[r]>>regbit)<<2) | 3 & (regs[r+3]>>regbit)
-    	    offs[level] = 0.15 * bits_to_off[bits]
-    	    if regbit == 14:
-    	        regbit = 0
-    	        r -= 1
-    	    else:
-    	        regbit += 2
-        return offs
+        "The 17 INL offsets from the six INL register values, see regs_to_inl."
+        return regs_to_inl(regs)
+
+    def get_register_image(self):
+        """
+        Returns the calibration state of the current zdok: the control
+        register and a 4x9 array with the offset, gain, phase and six INL
+        registers of each channel.  Registers known in the shadow are not
+        read again.
+        """
+        control = self.get_spi_register(CONTROL_REG_ADDR-0x80)
+        channels = np.zeros((self.n_cores, len(BANKED_REG_ADDRS)), dtype='uint16')
+        for i, chan in enumerate(self.cores):
+            self.set_spi_register(CHANSEL_REG_ADDR, chan)
+            for j, addr in enumerate(BANKED_REG_ADDRS):
+                channels[i, j] = self.get_spi_register(addr-0x80)
+        return control, channels
+
+    def set_register_image(self, control, channels, force = True):
+        """
+        Load a register image, as returned by get_register_image, into the
+        current zdok.  Each channel is selected once and all its registers
+        loaded by a single CALCTRL.  Unless force is False, the shadow of
+        the zdok is cleared first so every register is written, as the ADC
+        may have been reset; otherwise channels (and the control register)
+        already holding the image in the shadow are skipped.
+        """
+        if force:
+            self.invalidate_shadow(self.zdok)
+        self.set_spi_register(CONTROL_REG_ADDR, int(control))
+        for i, chan in enumerate(self.cores):
+            if self.use_shadow and all([self.shadow[self.zdok].get((chan, addr)) == channels[i][j]
+                                        for j, addr in enumerate(BANKED_REG_ADDRS)]):
+                self.saved_transactions += len(BANKED_REG_ADDRS) + 2
+                continue
+            self.set_spi_register(CHANSEL_REG_ADDR, chan)
+            for j, addr in enumerate(BANKED_REG_ADDRS):
+                self.set_spi_register(addr, int(channels[i][j]))
+            self.set_spi_register(CALCTRL_REG_ADDR, CALCTRL_LOAD_ALL)
+
+    def save_register_image(self, filename):
+        "Save the register image of the current zdok to a binary (.npz) file."
+        control, channels = self.get_register_image()
+        np.savez(filename, zdok = self.zdok, control = control, channels = channels)
+
+    def load_register_image(self, filename):
+        "Read a register image saved by save_register_image, returns (control, channels)."
+        image = np.load(filename)
+        return int(image['control']), image['channels']
+
+    def apply_register_image(self, filename, force = True):
+        "Load the register image saved in filename into the current zdok, see set_register_image."
+        control, channels = self.load_register_image(filename)
+        self.set_register_image(control, channels, force)
 
     def set_control(self, adcmode=8, stdby=0, dmux=1, bg=1, bdw=3, fs=0, test=0):
         """
@@ -262,7 +461,7 @@ class SPI:
         """
         Gets the current value of the control register of an ADC over SPI.
         """
-        if not self.test:
+        if not self.test or self.in_shadow(CONTROL_REG_ADDR):
             reg_val = self.get_spi_register(CONTROL_REG_ADDR-0x80)
         else: 
             reg_val = 0x3c8
@@ -285,7 +484,19 @@ class SPI:
         inc_mmcm_phase(roach, zdok_n)        # default increments
         inc_mmcm_phase(roach, zdok_n, inc=0) # set inc=0 to decrement
         """
-        data = (1<<(self.zdok*4)) + (inc<<(1+self.zdok*4))
+        self.inc_mmcm_phases({self.zdok: inc})
+
+    def inc_mmcm_phases(self, incs):
+        """
+        Increments (or decrements) the MMCM phase of several zdoks with a
+        single write.  incs maps each zdok to step to 1 to increment or 0
+        to decrement.
+
+        inc_mmcm_phases({0: 1, 1: 0})  # increment zdok 0, decrement zdok 1
+        """
+        data = 0
+        for zdok, inc in incs.items():
+            data += (1<<(zdok*4)) + (inc<<(1+zdok*4))
         reg_val = pack(OPB_DATA_FMT, data, 0x0, 0x0)
         self.blindwrite(reg_val, offset=0x0)        
 
@@ -296,11 +507,15 @@ class SPI:
     
         This should be used after setting test mode on.
         """
+        for zdok, synced in enumerate([zdok_0, zdok_1]):
+            if synced:
+                self.invalidate_shadow(zdok)
         self.blindwrite(pack('>BBBB', 0x00, 0x00, 0x00, 0x0), 0)
         self.blindwrite(pack('>BBBB', 0x00, 0x00, 0x00, zdok_0 + zdok_1*2), 0)
         self.blindwrite(pack('>BBBB', 0x00, 0x00, 0x00, 0x00), 0)            
 
     def set_test_mode(self, counter=True):
+        self.invalidate_shadow(self.zdok)
         if counter:
             self.use_counter_test()
         else:
@@ -325,6 +540,7 @@ class SPI:
         self.set_control(**new_control)
 
     def unset_test_mode(self):
+        self.invalidate_shadow(self.zdok)
         try:
             #self.roach_original_control[str(self.zdok)]['test'] = 0
             self.set_control(**self.roach_original_control[str(self.zdok)])
@@ -344,13 +560,22 @@ class SPI:
     def use_counter_test(self):
         self.set_spi_register(0x05+0x80,0)
 
+    def get_writes(self):
+        "The (offset, data) of the writes in the log."
+        log = self.log if self.log is not None else []
+        return [(offset, data) for start, kind, offset, data, latency in log if kind == 'w']
+
+    def get_regs(self):
+        "The (address, value) of the ADC registers written, from the log."
+        return [unpack(OPB_DATA_FMT, data)[1::-1] for offset, data in self.get_writes() if offset != 0]
+
     def get_hex_regs(self):
         "Its convinient to look at the address and values written in hex."
-        return [(hex(int(x)), hex(int(y))) for x, y in self.regs]
+        return [(hex(int(x)), hex(int(y))) for x, y in self.get_regs()]
 
     def get_int_roach_writes(self):
         "Its convinient to look at what we wrote to the roach as an unsigned int."
-        return [unpack(">I", data) for offset, data in self.writes]
+        return [unpack(">I", data) for offset, data in self.get_writes()]
 
 #    def get_adc_snapshot(self, snap_name = None, bitwidth=8, man_trig=True, wait_period=2):
 #        """
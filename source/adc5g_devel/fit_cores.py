@@ -4,7 +4,11 @@
 import sys
 import os
 import math
+import time
 import logging
+import threading
+import numpy as np
+from collections import OrderedDict
 #from scipy import *
 #import adc5g
 from numpy import array, zeros, savetxt, genfromtxt, shape, size
@@ -16,22 +20,271 @@ from scipy.special import erfc
 
 logger = logging.getLogger('adc5gLogging')
 
-sum_result = zeros((15), dtype=float)
-result_cnt = 0
-code_errors = zeros((256,4), dtype='float')
-ce_counts = zeros((256, 4), dtype='int32')
+# cores are in time sequence 1234, files and registers use the order abcd
+CORE_ORDER = [0, 2, 1, 3]
+
 timestamp = ''
 
+# maximum number of (frequency, snapshot length) bases kept by get_basis
+BASIS_CACHE_SIZE = 16
+_basis_cache = OrderedDict()
+_basis_lock = threading.Lock()
+
 def fitsin(p, s, c):
   return p[0] +  p[1] * s + p[2] * c
 
 def sin_residuals(p, s, c, adc):
   res = adc - fitsin(p, s, c)
-  for i in range(adc.size):
-    if adc[i] == -128 or adc[i] == 127:
-      res[i] = 0
+  res[(adc == -128) | (adc == 127)] = 0
   return res
 
+def core_basis(s, c, ncores=4):
+  """
+  Return the (1, sin, cos) basis of the sine fit split by core, as an
+  array of shape (ncycles, ncores, 3).  The last core cycle is padded with
+  zeros if the number of samples is not a multiple of ncores.
+  """
+  n = len(s)
+  basis = np.column_stack((np.ones(n), s, c))
+  pad = -n % ncores
+  if pad:
+    basis = np.vstack((basis, np.zeros((pad, 3))))
+  return basis.reshape(-1, ncores, 3)
+
+def get_basis(sig_freq, samp_freq, length, ncores=4):
+  """
+  Return (s, c, basis): the sin and cos of the signal phase at each of
+  length samples and the per core basis of core_basis.  They only depend
+  on the arguments, so they are computed once and kept in a cache of the
+  BASIS_CACHE_SIZE most recently used entries.  Repeated fits at the same
+  tone frequency (the repeats of an OGP calibration, or revisiting the
+  frequencies of a scan) reuse them.  The arrays are read only.
+  """
+  key = (sig_freq, samp_freq, length, ncores)
+  with _basis_lock:
+    entry = _basis_cache.pop(key, None)
+    if entry is None:
+      del_phi = 2 * math.pi * sig_freq / samp_freq
+      s = np.sin(del_phi * np.arange(length))
+      c = np.cos(del_phi * np.arange(length))
+      entry = (s, c, core_basis(s, c, ncores))
+      for a in entry:
+        a.flags.writeable = False
+    _basis_cache[key] = entry
+    while len(_basis_cache) > BASIS_CACHE_SIZE:
+      _basis_cache.popitem(last=False)
+  return entry
+
+def fit_cores_lsq(adc, s, c, ncores=4, basis=None):
+  """
+  Fit offset + sin + cos to the whole snapshot and to each of its ncores
+  interleaved cores.  Once the signal frequency is known the model is
+  linear in the three parameters, so instead of iterating with leastsq
+  the normal equations of all the fits are built at once and solved in
+  a single batched linear solve.  Clipped samples (-128 or 127) are
+  masked out, which gives the same solution as minimizing sin_residuals.
+  basis is core_basis(s, c, ncores), computed here if not given.
+
+  Returns an (ncores+1)x3 array with the (offset, sin, cos) parameters.
+  Row 0 is the fit to the full snapshot, rows 1..ncores the fits to each
+  core in time sequence.
+  """
+  if basis is None:
+    basis = core_basis(s, c, ncores)
+  adc = np.asarray(adc, dtype=float)
+  w = ((adc != -128) & (adc != 127)).astype(float)
+  # pad to a whole number of core cycles with zero weight samples so the
+  # cores can be split with a reshape
+  pad = -adc.size % ncores
+  if pad:
+    adc = np.concatenate((adc, np.zeros(pad)))
+    w = np.concatenate((w, np.zeros(pad)))
+  wbasis = basis * w.reshape(-1, ncores, 1)
+  ata = np.einsum('mki,mkj->kij', wbasis, basis)
+  aty = np.einsum('mki,mk->ki', wbasis, adc.reshape(-1, ncores))
+  ata = np.concatenate((ata.sum(axis=0)[np.newaxis], ata))
+  aty = np.concatenate((aty.sum(axis=0)[np.newaxis], aty))
+  return np.linalg.solve(ata, aty[:, :, np.newaxis])[:, :, 0]
+
+class CodeResidualAccumulator:
+  """
+  Accumulates, for each output code of each core, the sum of the residuals
+  (code - fitted value) and the number of samples that produced that code.
+  These are the raw data for the INL corrections.  Snapshots can be added
+  one after the other and accumulators of different snapshots merged, so
+  the residuals can be averaged over as many snapshots as needed.
+  """
+
+  def __init__(self, ncores=4, ncodes=256):
+    self.ncores = ncores
+    self.ncodes = ncodes
+    self.clear()
+
+  def clear(self):
+    # indexed [code][core] with code in offset binary and cores in time
+    # sequence
+    self.code_errors = zeros((self.ncodes, self.ncores), dtype='float')
+    self.ce_counts = zeros((self.ncodes, self.ncores), dtype='int64')
+
+  def add(self, snap, fit):
+    """
+    Add the residuals of a snapshot.  snap holds the codes of the
+    interleaved cores in time sequence and fit the fitted value of each
+    sample (using the sine fit of its own core).
+    """
+    snap = np.asarray(snap).astype(int)
+    core = np.arange(snap.size) % self.ncores
+    # a single bin for each (code, core) pair so all the cores are
+    # accumulated in one pass
+    bins = (snap + self.ncodes//2) * self.ncores + core
+    nbins = self.ncodes * self.ncores
+    self.code_errors += np.bincount(bins, weights=snap - fit,
+                                    minlength=nbins).reshape(self.ncodes, -1)
+    self.ce_counts += np.bincount(bins,
+                                  minlength=nbins).reshape(self.ncodes, -1)
+
+  def merge(self, other):
+    "Add the sums and counts of another accumulator to this one."
+    self.code_errors += other.code_errors
+    self.ce_counts += other.ce_counts
+    return self
+
+  def residuals(self):
+    """
+    Return the average residual of each code as a 4x256 array, with the
+    cores in the order a, b, c, d.  Codes with less than two samples in
+    any of the cores are set to zero.
+    """
+    res = zeros((self.ncodes, self.ncores), dtype='float')
+    good = self.ce_counts.min(axis=1) > 1
+    res[good] = self.code_errors[good] / self.ce_counts[good]
+    return res[:, CORE_ORDER].transpose()
+
+  def save_res(self, fname):
+    """
+    Write the residuals to fname, one line per code with the cores in
+    the order a, b, c, d.  Since the INL registers are addressed as
+    offset binary, codes are written that way.
+    """
+    data = np.column_stack((arange(self.ncodes), self.residuals().transpose()))
+    savetxt(fname, data, fmt=('%3d', '%5.3f', '%5.3f', '%5.3f', '%5.3f'))
+    print("written to file " + fname)
+
+class HistogramAccumulator:
+  """
+  Code density histogram of each core, accumulated snapshot by snapshot.
+  Only the counts are kept, so any number of snapshots can be added in
+  bounded memory until the histogram is good enough for fit_hist.
+  """
+
+  def __init__(self, ncores=4, ncodes=256):
+    self.ncores = ncores
+    self.ncodes = ncodes
+    self.clear()
+
+  def clear(self):
+    # indexed [code][core] with code in offset binary and cores in time
+    # sequence, as in CodeResidualAccumulator
+    self.counts = zeros((self.ncodes, self.ncores), dtype='int64')
+    self.nsnaps = 0
+
+  def add(self, snap):
+    "Add the codes of a snapshot of interleaved cores in time sequence."
+    snap = np.asarray(snap).astype(int)
+    core = np.arange(snap.size) % self.ncores
+    bins = (snap + self.ncodes//2) * self.ncores + core
+    self.counts += np.bincount(bins, minlength=self.ncodes*self.ncores
+                               ).reshape(self.ncodes, -1)
+    self.nsnaps += 1
+
+  def merge(self, other):
+    "Add the counts of another accumulator to this one."
+    self.counts += other.counts
+    self.nsnaps += other.nsnaps
+    return self
+
+  def hist(self):
+    "Return the counts as a 4x256 array with the cores in the order a, b, c, d."
+    return self.counts[:, CORE_ORDER].transpose()
+
+  def max_error(self, min_fraction=0.01):
+    """
+    Return the largest relative statistical error, 1/sqrt(count), of the
+    codes the fit depends on.  The end codes, which also count the
+    overranges, are left out, and so are the codes of each core with less
+    than min_fraction of its median count: the codes just past the
+    amplitude of a sine that doesn't reach full scale only get the odd
+    count from noise, and would never reach the error.  Returns 1 if no
+    code was seen.
+    """
+    counts = self.counts[1:-1].astype(float)
+    seen = np.where(counts > 0, counts, np.nan)
+    with np.errstate(invalid='ignore'):
+      median = np.nanmedian(seen, axis=0)
+      used = counts[(counts > 0) & (counts >= min_fraction * median)]
+    if used.size == 0:
+      return 1.0
+    return 1/np.sqrt(used.min())
+
+  def save_hist(self, fname):
+    """
+    Write the histogram to fname, one line per code (offset binary) with
+    the counts of cores a, b, c, d, as read by fit_hist.
+    """
+    data = np.column_stack((arange(self.ncodes), self.hist().transpose()))
+    savetxt(fname, data, fmt='%d')
+    print("written to file " + fname)
+
+class OgpInlAccumulator:
+  """
+  Running state of a series of snapshot fits: the sum and count of the
+  offset, gain and phase results (ogp) and the INL raw data.  Each zdok or
+  board being fitted should use its own accumulator.  Partial accumulators,
+  for example filled by different threads or processes with fits of
+  different snapshots, can be combined with merge().
+  """
+
+  def __init__(self):
+    self.code_residuals = CodeResidualAccumulator()
+    self.clear()
+
+  def clear(self):
+    self.sum_result = zeros((15), dtype=float)
+    self.result_cnt = 0
+    self.code_residuals.clear()
+
+  def add(self, result, snap, core_fit):
+    "Add the ogp result and the code residuals of one snapshot."
+    self.sum_result += array(result)
+    self.result_cnt += 1
+    self.code_residuals.add(snap, core_fit)
+
+  def merge(self, other):
+    "Add the state of another accumulator to this one."
+    self.sum_result += other.sum_result
+    self.result_cnt += other.result_cnt
+    self.code_residuals.merge(other.code_residuals)
+    return self
+
+  def ogp(self, sig_freq=None):
+    """
+    Return the average of the accumulated results as a tuple of 15:
+    signal freq, average zero, average amplitude followed by triplets of
+    zero, amplitude and phase differences for cores a, b, c and d.
+    """
+    avg_result = self.sum_result/self.result_cnt
+    if sig_freq is not None:
+      avg_result[0] = sig_freq
+    return tuple(avg_result)
+
+  def residuals(self):
+    "Average code residuals as a 4x256 array, see CodeResidualAccumulator."
+    return self.code_residuals.residuals()
+
+# used by callers of fit_snap and fit_snap_data that don't give their own
+# accumulator
+default_accumulator = OgpInlAccumulator()
+
 def test_fit_snap():
 
     # default values: from nrao_adc5g_test
@@ -67,66 +320,77 @@ def test_fit_snap():
     diffs = [(abs(x-y), (abs((x-y)/y))*100.) for x, y in zip(t,ogp)] 
     print diffs
     
-def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True):
+def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True, acc=None):
+  """
+  Given a file containing a snapshot of data (one sample per line), fit
+  a separate sine wave to each of the 4 cores with fit_snap_data.  The
+  fit artifacts are written next to the snapshot file, see fit_snap_data.
+  """
+  snap = np.loadtxt(fname, dtype=int, comments='#').astype(np.int8)
+  return fit_snap_data(snap, sig_freq, samp_freq, clear_avgs = clear_avgs,
+                       prnt = prnt, fname = fname, acc = acc)
+
+def save_fit(fname, snap, fit, core_fit):
+  """
+  Write the snapshot, the fit to the full snapshot and the per-core fits
+  (all in time sequence) to the binary file fname.npz.
   """
-  Given a file containing a snapshot of data, separate the data from the
+  outfn = fname + ".npz"
+  np.savez(outfn, snap=snap, fit=fit, core_fit=core_fit)
+  print("written to file " + outfn)
+
+def save_ogp(fname, acc, sig_freq):
+  """
+  Append the averaged ogp of the accumulator acc, preceded by the number of
+  snapshots averaged, to fname.ogp.
+  """
+  logstr = str(acc.result_cnt) + " " + "%8.4f "*15 % acc.ogp(sig_freq)
+  ofn = fname  + ".ogp"
+  print("Writing to file " + ofn + ": " + logstr)
+  with open(ofn, 'a') as ofd:
+    ofd.write(logstr)
+
+def snap_fits(snap, sig_freq, samp_freq):
+  """
+  Fit a snapshot of interleaved cores.  Returns the fitted parameters (see
+  fit_cores_lsq), the fit to the full snapshot and the fitted value of
+  every sample using the parameters of its own core, as saved by save_fit.
+  """
+  adc = np.asarray(snap).astype(float)
+  s, c, basis = get_basis(sig_freq, samp_freq, adc.size)
+  plsq = fit_cores_lsq(adc, s, c, basis=basis)
+  fit = fitsin(plsq[0], s, c)
+  core_fit = fitsin(plsq[1 + np.arange(adc.size) % 4].T, s, c)
+  return plsq, fit, core_fit
+
+def fit_snap_data(snap, sig_freq, samp_freq, clear_avgs=True, prnt=True,\
+                  fname=None, acc=None):
+  """
+  Given a snapshot of data as an int8 array, separate the data from the
   4 cores and fit a separate sine wave to each.  From the dc offset, gain
   and phase of the four fits, report the average and the difference of each
-  core from the average.  Write a line in fname.fit giving these values.
-  Compute the average difference between the fitted value and measured value
-  for each level of each core averaged over the samples (the raw data for
-  INL corrections) and write to fname.res.
+  core from the average.  Compute the average difference between the fitted
+  value and measured value for each level of each core averaged over the
+  samples (the raw data for INL corrections).
+
+  Everything is kept in memory.  Only if fname is given (and prnt is set)
+  the results are persisted: the snapshot and fits go to fname.npz, the
+  averaged ogp line is appended to fname.ogp and the INL raw data is
+  written to fname.res.
+
+  The running averages are kept in acc, an OgpInlAccumulator, which is
+  cleared first if clear_avgs is set.  If acc is not given the module's
+  default_accumulator is used.
 
   Internally, cores 1-4 are in time sequence, but when the data is
   written out, write in teh sequence 1324 for cores abcd.
   """
-  global sum_result, result_cnt, code_errors, ce_counts
-  p0 = [128.0, 90.0, 90.0]
+  acc = default_accumulator if acc is None else acc
   ogp = ()
-  
-  # Create lists to hold parameters at sample rate
-  adc = []    # adc value
-  s = []        # sin of signal freq
-  c = []        # cos of signal freq
-  
-  del_phi = 2 * math.pi * sig_freq / samp_freq
-  ifn = fname 
-  ifd=open(ifn, 'r')
-  ofn = fname  + ".ogp"
-  ofd = open(ofn, 'a')
-  if prnt:
-    cfd1fn = fname  + ".a"
-    cfd1 = open(cfd1fn, 'w')
-    cfd2fn = fname  + ".b"
-    cfd2 = open(cfd2fn, 'w')
-    cfd3fn = fname  + ".c"
-    cfd3 = open(cfd3fn, 'w')
-    cfd4fn = fname  + ".d"
-    cfd4 = open(cfd4fn, 'w')
-  data_cnt = 0
-  for line in ifd:
-    if line[0] == "#":
-      continue
-    adc += [int(line)]
-    s += [math.sin(del_phi * data_cnt)]
-    c += [math.cos(del_phi * data_cnt)]
-    data_cnt += 1
-  
-  core1 = adc[0:: 4]
-  core2 = adc[1:: 4]
-  core3 = adc[2:: 4]
-  core4 = adc[3:: 4]
-  s1 = s[0:: 4]
-  s2 = s[1:: 4]
-  s3 = s[2:: 4]
-  s4 = s[3:: 4]
-  c1 = c[0:: 4]
-  c2 = c[1:: 4]
-  c3 = c[2:: 4]
-  c4 = c[3:: 4]
-  
-  ifd.close()
 
+  snap = np.asarray(snap)
+  adc = snap.astype(float)
+  data_cnt = adc.size
 
 # express offsets as mV.  1 lsb = 500mV/256. z_fact converts from lsb to mV
 # negate z_fact for negative feedback
@@ -139,58 +403,16 @@ def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True):
 #  d_fact = samp_freq/(2*math.pi*sig_freq)
 #  d_fact = 1
 
-  args0 = (array(s), array(c), array(adc))
-  plsq0 = leastsq(sin_residuals, p0, args0)
-  #if plsq1[1] != 1:
-  #  print "Fit failed to converge"
-  z0 = z_fact * plsq0[0][0]
-  s0a = plsq0[0][1]
-  c0a = plsq0[0][2]
-  amp0 = math.sqrt(s0a**2 + c0a**2)
-  dly0 = d_fact*math.atan2(s0a, c0a)
-  Fit0 = fitsin(plsq0[0], args0[0], args0[1])
-  tmpfn = fname  + ".fit"
-  print("savetxt to ..." + tmpfn)
-  savetxt(tmpfn, Fit0)
-  ssq0 = 0.0
-  for i in range(data_cnt):
-    ssq0 += (adc[i] - Fit0[i])**2
+  plsq, Fit0, core_fit = snap_fits(snap, sig_freq, samp_freq)
+  z = z_fact * plsq[:, 0]
+  amp = np.hypot(plsq[:, 1], plsq[:, 2])
+  dly = d_fact * np.arctan2(plsq[:, 1], plsq[:, 2])
+  z0, z1, z2, z3, z4 = z
+  amp0, amp1, amp2, amp3, amp4 = amp
+  dly0, dly1, dly2, dly3, dly4 = dly
+  ssq0 = np.sum((adc - Fit0)**2)
   pwr_sinad = (amp0**2)/(2*ssq0/data_cnt)
 
-  args1 = (array(s1), array(c1), array(core1))
-  plsq1 = leastsq(sin_residuals, p0, args1)
-  #if plsq1[1] != 1:
-  #  print "Fit failed to converge"
-  z1 = z_fact * plsq1[0][0]
-  s1a = plsq1[0][1]
-  c1a = plsq1[0][2]
-  amp1 = math.sqrt(s1a**2 + c1a**2)
-  dly1 = d_fact*math.atan2(s1a, c1a)
-  
-  args2 = (array(s2), array(c2), array(core2))
-  plsq2 = leastsq(sin_residuals, p0, args2)
-  z2 = z_fact * plsq2[0][0]
-  s2a = plsq2[0][1]
-  c2a = plsq2[0][2]
-  amp2 = math.sqrt(s2a**2 + c2a**2)
-  dly2 = d_fact*math.atan2(s2a, c2a)
-  
-  args3 = (array(s3), array(c3), array(core3))
-  plsq3 = leastsq(sin_residuals, p0, args3)
-  z3 = z_fact * plsq3[0][0]
-  s3a = plsq3[0][1]
-  c3a = plsq3[0][2]
-  amp3 = math.sqrt(s3a**2 + c3a**2)
-  dly3 = d_fact*math.atan2(s3a, c3a)
-  
-  args4 = (array(s4), array(c4), array(core4))
-  plsq4 = leastsq(sin_residuals, p0, args4)
-  z4 = z_fact * plsq4[0][0]
-  s4a = plsq4[0][1]
-  c4a = plsq4[0][2]
-  amp4 = math.sqrt(s4a**2 + c4a**2)
-  dly4 = d_fact*math.atan2(s4a, c4a)
-
   avz = (z1+z2+z3+z4)/4.0
   avamp = (amp1+amp2+amp3+amp4)/4.0
   # Reverse the amplitude and zero differences so they can be applied to the
@@ -201,7 +423,6 @@ def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True):
   a3p = 100*(avamp -amp3)/avamp
   a4p = 100*(avamp -amp4)/avamp
   avdly = (dly1+dly2+dly3+dly4)/4.0
-#  print s1a, c1a, s2a, c2a, s3a, c3a, s4a, c4a
   if prnt:
     print( "#%6.2f  zero(mV) amp(%%)  dly(ps) (adj by .4, .14, .11)" % (sig_freq))
     print( "#avg    %7.4f %7.4f %8.4f" %  (avz, avamp, avdly))
@@ -212,28 +433,20 @@ def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True):
     print( "\nsinad = %.2f" % (10.0*math.log10(pwr_sinad)))
 
   if clear_avgs:
-    sum_result = zeros((15), dtype=float)
-    result_cnt = 0
-    code_errors = zeros((256,4), dtype='float')
-    ce_counts = zeros((256, 4), dtype='int32')
+    acc.clear()
 
   result = (sig_freq, avz, avamp,\
       z1-true_zero, a1p, dly1-avdly, z3-true_zero, a3p, dly3-avdly, \
       z2-true_zero, a2p, dly2-avdly, z4-true_zero, a4p, dly4-avdly)
-  result_fmt = "%8.4f "*15
-  sum_result += array(result)
-  result_cnt += 1
-#  print "%.3f %.3f %.3f %.3f %d" % (sum_result[5]/result_cnt,\
-#     sum_result[8]/result_cnt,\
-#     sum_result[11]/result_cnt, sum_result[14]/result_cnt, result_cnt)
-  if prnt and result_cnt > 1:
-    avg_result = sum_result/result_cnt
-    avg_result[0] = sig_freq
-    ogp = tuple(avg_result)
-    logstr = str( result_cnt) + " " + result_fmt % ogp
-    print("Writing to file " + ofn + ": " + logstr)
-    ofd.write(logstr)
-    print( "average of %d measurements" % (result_cnt))
+  # for each core accumulate the sum of the residuals at each output code
+  # and the count of residuals added
+  acc.add(result, snap, core_fit)
+  save = prnt and fname is not None
+  if prnt and acc.result_cnt > 1:
+    ogp = acc.ogp(sig_freq)
+    if save:
+      save_ogp(fname, acc, sig_freq)
+    print( "average of %d measurements" % (acc.result_cnt))
     print( "#avg    %7.4f %7.4f %8.4f" %  (ogp[1], ogp[2], 0))
     print( "core A  %7.4f %7.4f %8.4f" %  ogp[3:6])
     print( "core B  %7.4f %7.4f %8.4f" %  ogp[6:9])
@@ -241,67 +454,65 @@ def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True):
     print( "core D  %7.4f %7.4f %8.4f" %  ogp[12:15])
     print("")
 
-  # for each core (n), accumulate the sum of the residuals at each output code
-  # in code_errors[code][n]
-  # and the count of residuals added in ce_counts[code][n]
-  Fit1 = fitsin(plsq1[0], args1[0], args1[1])
-  for i in range(data_cnt/4):
-    code = core1[i]
-    if prnt:
-      logstr = "%d %d %.2f\n" % (4 * i, code, Fit1[i])
-      cfd1.write(logstr)
-    code_errors[code+128][0] += code - Fit1[i]
-    ce_counts[code+128][0] += 1
-  if prnt:
-    print("written to file " + cfd1fn)
-  Fit2 = fitsin(plsq2[0], args2[0], args2[1])
-  for i in range(data_cnt/4):
-    code = core2[i]
-    if prnt:
-      logstr =  "%d %d %.2f\n" % (4 * i + 1, code, Fit2[i])
-      cfd3.write(logstr)
-    code_errors[code+128][1] += code - Fit2[i]
-    ce_counts[code+128][1] += 1
-  if prnt:
-    print("written to file " + cfd3fn)
-  Fit3 = fitsin(plsq3[0], args3[0], args3[1])
-  for i in range(data_cnt/4):
-    code = core3[i]
-    if prnt:
-      logstr = "%d %d %.2f\n" % (4 * i + 2, code, Fit3[i])
-      cfd2.write(logstr)
-    code_errors[code+128][2] += code - Fit3[i]
-    ce_counts[code+128][2] += 1
-  if prnt:
-    print("written to file " + cfd2fn)
-  Fit4 = fitsin(plsq4[0], args4[0], args4[1])
-  for i in range(data_cnt/4):
-    code = core4[i]
-    if prnt:
-      logstr = "%d %d %.2f\n" % (4 * i + 3, code, Fit4[i])
-      cfd4.write(logstr)
-    code_errors[code+128][3] += code - Fit4[i]
-    ce_counts[code+128][3] += 1
-  if prnt:
-    print("written to file " + cfd4fn)
-  if prnt:
-    rfdfn = fname + '.res'
-    rfd = open(rfdfn, "w")
-    # Since the INL registers are addressed as offset binary, generate the
-    # .res file that way
-    for code in range(256):
-      if ce_counts[code].min() > 1:
-        e = code_errors[code]/ce_counts[code]
-        logstr = "%3d %5.3f %5.3f %5.3f %5.3f\n" % \
-                 (code, e[0], e[2], e[1], e[3])
-        rfd.write(logstr)
-      else:
-        logstr = "%3d %5.3f %5.3f %5.3f %5.3f\n" % (code,0,0,0,0)
-        rfd.write(logstr)
-  if prnt:
-    print("written to file " + rfdfn)
+  if save:
+    save_fit(fname, snap, Fit0, core_fit)
+    acc.code_residuals.save_res(fname + '.res')
   return ogp, pwr_sinad
 
+def fit_snap_partial(args):
+  """
+  Fit one snapshot into a new OgpInlAccumulator.  args is the tuple
+  (snap, sig_freq, samp_freq).  Meant to be run by worker processes:
+  returns the accumulator, which is small to send back and can be merged
+  with the others, the sinad and the time spent fitting.
+  """
+  snap, sig_freq, samp_freq = args
+  start = time.time()
+  acc = OgpInlAccumulator()
+  ogp, pwr_sinad = fit_snap_data(snap, sig_freq, samp_freq, prnt=False, acc=acc)
+  return acc, pwr_sinad, time.time() - start
+
+def inl_weights(codes):
+  """
+  Return the 17 x len(codes) matrix of weights used to average the code
+  residuals around each INL correction level (codes 0, 16, ... 256).  The
+  kernel is triangular: code 16*level + k has weight 16 - |k| for |k| < 16.
+  The end codes 0 and 255 are never used.
+  """
+  codes = np.asarray(codes)
+  dist = np.abs(codes[np.newaxis, :] - 16*arange(17)[:, np.newaxis])
+  wts = np.clip(16 - dist, 0, None).astype(float)
+  wts[:, (codes == 0) | (codes == 255)] = 0
+  return wts
+
+def inl_corrections(res, codes=None):
+  """
+  Compute the INL corrections from the code residuals in memory.  res is
+  an array with the residual of each code in its last axis, e.g. the 4x256
+  array of OgpInlAccumulator.residuals() (cores a, b, c, d), and codes the
+  code of each column (0..255 by default).  All the levels of all the
+  cores are computed with a single weighted matrix product.
+
+  Returns an array of the same leading shape with the 17 corrections in
+  its last axis.  Levels without residuals around them are zero.
+  """
+  res = np.asarray(res, dtype=float)
+  if codes is None:
+    codes = arange(res.shape[-1])
+  wts = inl_weights(codes)
+  wt = wts.sum(axis=1)
+  wt[wt == 0] = np.inf
+  return np.dot(res, wts.transpose()) / wt
+
+def save_inl(outname, inls):
+  """
+  Write the 4x17 INL corrections to outname, one line per level with the
+  level followed by the corrections of cores a, b, c and d.
+  """
+  corrections = np.column_stack((16*arange(17), np.transpose(inls)))
+  print("savetxt to ..." + outname)
+  savetxt(outname, corrections, fmt=('%3d','%7.4f','%7.4f','%7.4f','%7.4f'))
+
 def fit_inl(fname='t.res', outname = None):
   """
   Read the raw residuals from fname.res and compute the INL corrections
@@ -314,10 +525,6 @@ def fit_inl(fname='t.res', outname = None):
       else:
           outname = 'inl%s.meas'%timestamp
 
-  corrections = zeros((17,5), dtype='float')
-  wts = array([1.,2.,3.,4.,5.,6.,7.,8.,9.,10.,11.,12.,13.,14.,15,16,\
-        15.,14.,13.,12.,11.,10.,9.,8.,7.,6.,5.,4.,3.,2.,1.])
-
   data = genfromtxt(fname, unpack=True)
   start_data = int(data[0][0])
   file_limit = len(data[0])
@@ -326,106 +533,128 @@ def fit_inl(fname='t.res', outname = None):
   if data[0][data_limit - start_data - 1] != data_limit - 1:
     print( "there are holes in the data file")
     return
+  inls = inl_corrections(data[1:5], data[0])
   for corr_level in range(17):
-    # a and b are positions in the file
-    a = corr_level*16 - 15 - start_data
-    b = a + 31
-    if a < 0:
-      a = 0
-    if a == 0 and start_data == 0:
-      a = 1
-    if b > file_limit:
-      b = file_limit
-    if b == file_limit and data_limit == 256:
-      b -= 1
-    if a > b:
-      continue
-    wt_a = a - corr_level*16 + 15 + start_data
-    wt_b = wt_a -a + b
-    wt = sum(wts[wt_a:wt_b])
-    av1 = sum(data[1][a:b]*wts[wt_a:wt_b])/wt
-    av2 = sum(data[2][a:b]*wts[wt_a:wt_b])/wt
-    av3 = sum(data[3][a:b]*wts[wt_a:wt_b])/wt
-    av4 = sum(data[4][a:b]*wts[wt_a:wt_b])/wt
-    print("%d %7.5f %7.5f %7.5f %7.5f" %  (16*corr_level,av1,av2,av3,av4))
-    corrections[corr_level][0] = 16*corr_level
-    corrections[corr_level][1] = av1
-    corrections[corr_level][2] = av2
-    corrections[corr_level][3] = av3
-    corrections[corr_level][4] = av4
-  #if fname[:4] == 'hist':
-  #  outname = 'hist_inl%s.meas'%timestamp
-  #else:
-  #  outname = 'inl%s.meas'%timestamp
-  print("savetxt to ..." + outname)
-  savetxt(outname, corrections, fmt=('%3d','%7.4f','%7.4f','%7.4f','%7.4f'))
-  return corrections.transpose()[1:5]
+    print("%d %7.5f %7.5f %7.5f %7.5f" %  ((16*corr_level,) + tuple(inls[:, corr_level])))
+  save_inl(outname, inls)
+  return inls
+
+
+def _peak_max(labels, values, npeaks):
+  """
+  Return, for each peak label 0..npeaks, the flat index of the bin with the
+  largest value in that peak.
+  """
+  labels = labels.ravel()
+  order = np.lexsort((values.ravel(), labels))
+  last = np.append(labels[order][1:] != labels[order][:-1], True)
+  peak_bin = np.zeros(npeaks + 1, dtype=int)
+  peak_bin[labels[order][last]] = order[last]
+  return peak_bin
+
+def spectral_metrics(freqs, psd_db, sig_freq):
+  """
+  Compute the signal power, SFDR, SINAD, worst spur and ENOB of power
+  spectra in dB.  psd_db is either one spectrum or a 2-D array with one
+  spectrum per row (e.g. a whole frequency scan), freqs the frequency of
+  each bin and sig_freq the tone frequency (a scalar or one per spectrum).
+
+  As in dosfdr, a peak is a run of bins above -70 dB when within 4 MHz of
+  the tone and above -90 dB elsewhere.  The signal is the peak holding the
+  bin closest to the tone and the worst spur the strongest of the other
+  peaks, located at its maximum.  All the spectra are processed at once.
+
+  Returns a dictionary with sig_pwr, sig_db, sfdr, sinad, spur_freq,
+  spur_db and enob, as arrays with one value per spectrum (or scalars for
+  a single spectrum).
+  """
+  psd_db = np.asarray(psd_db, dtype=float)
+  single = psd_db.ndim == 1
+  psd_db = np.atleast_2d(psd_db)
+  nspec, nbins = psd_db.shape
+  freqs = np.asarray(freqs, dtype=float)
+  sig_freq = np.asarray(sig_freq, dtype=float) * np.ones(nspec)
+  pwr = 10**(psd_db/10.)
+  tot_pwr = pwr.sum(axis=1)
+
+  dist = np.abs(freqs[np.newaxis, :] - sig_freq[:, np.newaxis])
+  in_peak = psd_db > np.where(dist < 4, -70., -90.)
+  # label each run of bins in a peak, labels are unique over all spectra
+  # and 0 is for bins out of any peak
+  start = in_peak.copy()
+  start[:, 1:] &= ~in_peak[:, :-1]
+  labels = np.cumsum(start.ravel()).reshape(in_peak.shape) * in_peak
+  npeaks = labels.max()
+  peak_pwr = np.bincount(labels.ravel(), weights=pwr.ravel(), minlength=npeaks+1)
+  peak_pwr[0] = 0
+  peak_spec = np.append(-1, np.nonzero(start)[0])
+  peak_bin = _peak_max(labels, psd_db, npeaks)
+
+  sig_label = labels[arange(nspec), dist.argmin(axis=1)]
+  sig_pwr = peak_pwr[sig_label]
+
+  # the strongest peak of each spectrum that is not the signal
+  spur_pwr = peak_pwr.copy()
+  spur_pwr[sig_label] = 0
+  order = np.lexsort((spur_pwr[1:], peak_spec[1:])) + 1
+  last = np.append(peak_spec[order][1:] != peak_spec[order][:-1], True)
+  spur_label = np.zeros(nspec, dtype=int)
+  spur_label[peak_spec[order][last]] = order[last]
+  spur_label[spur_pwr[spur_label] == 0] = 0
 
+  with np.errstate(divide='ignore', invalid='ignore'):
+    sinad = 10.0*np.log10(sig_pwr/(tot_pwr - sig_pwr))
+    metrics = {'sig_pwr'   : sig_pwr,
+               'sig_db'    : np.where(sig_label > 0, psd_db.ravel()[peak_bin[sig_label]], np.nan),
+               'sfdr'      : 10.0*np.log10(sig_pwr/spur_pwr[spur_label]),
+               'sinad'     : sinad,
+               'spur_freq' : np.where(spur_label > 0, freqs[peak_bin[spur_label] % nbins], np.nan),
+               'spur_db'   : np.where(spur_label > 0, psd_db.ravel()[peak_bin[spur_label]], np.nan),
+               'enob'      : (sinad - 1.76)/6.02}
+  if single:
+    metrics = dict((k, v[0]) for k, v in metrics.items())
+  return metrics
 
 def dosfdr(sig_freq, fname = 'psd'):
   """
   Read the psd data from a file and calculate the SFDR and SINAD.  Write the
-  results in a file named sfdr
+  results in a file named sfdr.  Returns the spectral_metrics of the psd.
   """
-  
-  tot_pwr = 0.0
-  in_peak = False
-  spur_pwr = 0.0
-  for line in open(fname , 'r'):
-    f, d = line.split()
-    freq = float(f)
-    if abs(freq - sig_freq) < 4:
-      test = -70
-    else:
-      test = -90
-    db = float(d)
-    pwr = 10**(float(db)/10.)
-    tot_pwr += pwr
-    if in_peak:
-      if db < test:
-        in_peak = False
-        if abs(peak_freq - sig_freq) < 1:
-          sig_pwr = pwr_in_peak
-          sig_db = peak_db
-          peak_sig_freq = peak_freq
-        else:
-          if pwr_in_peak > spur_pwr:
-            spur_pwr = pwr_in_peak
-            spur_db = peak_db
-            spur_freq = peak_freq
-      else:
-        pwr_in_peak += 10**(float(db)/10.)
-        if db > peak_db:
-          peak_db = db
-        peak_freq = freq
-    elif db > test:
-      pwr_in_peak = 10**(float(db)/10.)
-      peak_freq = freq
-      peak_db = db
-      in_peak = True
+  freqs, psd_db = np.loadtxt(fname, unpack=True)
+  metrics = spectral_metrics(freqs, psd_db, sig_freq)
   outfdfn = 'sfdr' + timestamp
   outfd = open(outfdfn, 'a')
-  sfdr = 10.0*math.log10(sig_pwr / spur_pwr)
-  sinad = 10.0*math.log10(sig_pwr/(tot_pwr - sig_pwr))
   logstr = "%8.3f %6.2f %6.2f %6.2f %7.2f" %\
-        (sig_freq, sig_db, sfdr, sinad, spur_freq)
+        (sig_freq, metrics['sig_db'], metrics['sfdr'], metrics['sinad'],
+         metrics['spur_freq'])
   print("writing to file " + outfdfn + ": " + logstr)
   outfd.write(logstr)
+  outfd.close()
+  return metrics
 
 # Start of code for histograms
+def _hist_arg(p, codes):
+  "The normalized argument of the cumulative histogram models."
+  return (codes-127.5+p[1])/p[0]
+
+def _arg_jacobian(p, codes, dfdu):
+  """
+  Chain rule for the parameters (amplitude, offset) of the models, given
+  the derivative of the model with respect to its argument.
+  """
+  u = _hist_arg(p, codes)
+  return np.column_stack((-dfdu*u/p[0], dfdu/p[0]))
+
 def cumsin(p, codes):
-  amp = p[0]
-  arg=(codes-127.5+p[1])/amp
-  for i in range(size(arg)):
-    a = arg[i]
-    if a > 1.0:
-      arg[i] = 1.0
-    elif a < -1.0:
-      arg[i] = 0.0
-    else:
-      arg[i] = 1-arccos(a)/pi
-  return arg
-#  return array([(sign(a)+1)/2 if abs(a) > 1.0 else 1-arccos(a)/pi for a in arg])
+  "Cumulative histogram of a sine wave of amplitude p[0] and offset p[1]."
+  return 1 - arccos(np.clip(_hist_arg(p, codes), -1.0, 1.0))/pi
+
+def dcumsin(p, codes):
+  "Jacobian of cumsin, one row of (d/damp, d/doffset) per code."
+  u = _hist_arg(p, codes)
+  inside = absolute(u) < 1.0
+  dfdu = np.where(inside, 1/(pi*np.sqrt(np.where(inside, 1 - u*u, 1.0))), 0.0)
+  return _arg_jacobian(p, codes, dfdu)
 
 def pltcumsin(p):
   codes = array(range(0,256), dtype=float)
@@ -434,9 +663,13 @@ def pltcumsin(p):
   return cum
 
 def cumgaussian(p, codes):
-  amp = p[0]
-  arg=(codes-127.5+p[1])/amp
-  return (1-erfc(arg)/2.0)
+  "Cumulative histogram of gaussian noise of width p[0] and offset p[1]."
+  return (1-erfc(_hist_arg(p, codes))/2.0)
+
+def dcumgaussian(p, codes):
+  "Jacobian of cumgaussian, one row of (d/damp, d/doffset) per code."
+  u = _hist_arg(p, codes)
+  return _arg_jacobian(p, codes, np.exp(-u*u)/np.sqrt(pi))
 
 def pltcumgaussian(p):
   codes = array(range(0,256), dtype=float)
@@ -447,32 +680,67 @@ def pltcumgaussian(p):
 def hist_residuals(p, codes, cumhist, fit_function):
   return cumhist - fit_function(p, codes)
 
-def fit_hist(core=1, type='sin', fname='hist_cores'):
-  global cumhist, hist, plsq, cumresid, extended_fit
+def _cores_hist_residuals(p, codes, cumhist, fit_function, jacobian):
+  "Residuals of all the cores, p holds (amplitude, offset) of each core."
+  p = p.reshape(-1, 2)
+  return np.concatenate([hist_residuals(p[n], codes, cumhist[n], fit_function)
+                         for n in range(len(p))])
+
+def _cores_hist_jacobian(p, codes, cumhist, fit_function, jacobian):
+  "Block diagonal jacobian of _cores_hist_residuals."
+  p = p.reshape(-1, 2)
+  ncodes = len(codes)
+  jac = np.zeros((len(p)*ncodes, p.size))
+  for n in range(len(p)):
+    jac[n*ncodes:(n+1)*ncodes, 2*n:2*n+2] = -jacobian(p[n], codes)
+  return jac
+
+def fit_hist(core=None, type='sin', fname='hist_cores', hist=None):
+  """
+  Fit the cumulative code density histograms of the four cores with the
+  cumulative histogram of a sine wave (type 'sin') or of gaussian noise
+  (any other type).  All cores are fitted in a single leastsq call using
+  the analytic jacobian of the model.
 
-  coderesid=empty(256,dtype=float)
+  hist is a 4x256 array of counts per code for cores a, b, c and d.  If it
+  is not given it is read from the text file fname, whose columns are the
+  code followed by the counts of cores a to d.
+
+  Returns the fitted (amplitude, offset) of each core as a 4x2 array and
+  the code residuals as a 4x256 array, ready for inl_corrections.
+
+  core (1 to 4 for cores a to d) is kept for the old calls that fitted one
+  core at a time: if it is given, only that core is fitted and its
+  parameters and 256 code residuals are returned.  Give type, fname and hist
+  by keyword.
+  """
   if type == "sin":
-    fit_function = cumsin
+    fit_function, jacobian = cumsin, dcumsin
   else:
-    fit_function = cumgaussian
+    fit_function, jacobian = cumgaussian, dcumgaussian
   codes = arange(0,256, dtype=float)
-  # get the data as a 6x256 array, ie. hist[0] == arange(256)
-  hist = genfromtxt(fname, dtype=float, unpack=True)
-  t=float(sum(hist[core]))
-  cumhist=cumsum(hist[core])/t
-  args = (codes[0:255], cumhist[0:255], fit_function)
-  plsq = leastsq(hist_residuals, [135,0], args)
-  extended_fit = empty(258, dtype=float)
-  cumresid = hist_residuals(plsq[0],codes, cumhist, fit_function)
-  extended_fit[1:257] = cumhist-cumresid
-  extended_fit[0] = 2 * extended_fit[1] - extended_fit[2]
-  extended_fit[257] = 2 * extended_fit[256] - extended_fit[255]
+  if hist is None:
+    hist = genfromtxt(fname, dtype=float, unpack=True)[1:5]
+  hist = np.asarray(hist, dtype=float)
+  if core is not None:
+    params, coderesid = fit_hist(type=type, hist=hist[core-1:core])
+    return params[0], coderesid[0]
+  ncores = len(hist)
+  cumhist = cumsum(hist, axis=1)/hist.sum(axis=1)[:, np.newaxis]
+  args = (codes[0:255], cumhist[:, 0:255], fit_function, jacobian)
+  plsq = leastsq(_cores_hist_residuals, np.tile([135., 0.], ncores), args,
+                 Dfun=_cores_hist_jacobian)
+  params = plsq[0].reshape(ncores, 2)
+  cumresid = np.array([hist_residuals(params[n], codes, cumhist[n], fit_function)
+                       for n in range(ncores)])
+  extended_fit = empty((ncores, 258), dtype=float)
+  extended_fit[:, 1:257] = cumhist-cumresid
+  extended_fit[:, 0] = 2 * extended_fit[:, 1] - extended_fit[:, 2]
+  extended_fit[:, 257] = 2 * extended_fit[:, 256] - extended_fit[:, 255]
   # invert the sign of cumresid so inl corrections will be correct
-  for i in range(256):
-    if(cumresid[i] > 0 and extended_fit[i+2] > extended_fit[i+1]):
-      coderesid[i] = -cumresid[i] / (extended_fit[i+2] - extended_fit[i+1])
-    elif(extended_fit[i+1] > extended_fit[i]):
-      coderesid[i] = -cumresid[i] / (extended_fit[i+1] - extended_fit[i])
-    else:
-      coderesid[i]=0
-  return plsq[0], coderesid
+  up = extended_fit[:, 2:] - extended_fit[:, 1:257]
+  down = extended_fit[:, 1:257] - extended_fit[:, :256]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    coderesid = np.where((cumresid > 0) & (up > 0), -cumresid/up,
+                         np.where(down > 0, -cumresid/down, 0.0))
+  return params, coderesid
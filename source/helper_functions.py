@@ -1,7 +1,12 @@
 """
 Main calandigital script with helper functions.
 """
+import os
+import json
 import time
+import hashlib
+import tempfile
+import threading
 import corr
 import numpy as np
 from dummy_roach.dummy_roach import DummyRoach
@@ -265,3 +270,83 @@ def check_overflow(data, nbits, binpt, signed):
             print "WARNING! Minimum value exceeded in overflow check."
             print "Min allowed value: " + str(min_val_unsigned)
             print "Min value in data: " + str(np.min(data))
+
+def get_bof_hash(bof):
+    """
+    Identifies a bitstream for the calibration caches.
+    :param bof: .bof file, or a name unique to the bitstream (e.g. its md5)
+        if the file is not readable from here (e.g. it is on the ROACH).
+    :return: md5 of the .bof file if it is readable, else of bof itself.
+    """
+    if not bof:
+        raise ValueError("A bof file or an identifier of it is needed for the cache.")
+    bof = str(bof)
+    if os.path.isfile(bof):
+        with open(bof, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+    return hashlib.md5(bof).hexdigest()
+
+class JsonCache(object):
+    """
+    Dictionary of records kept in a JSON file, which is rewritten on every
+    change.  The file is written to a new temporary file and renamed, so it
+    is never left half written, and the records are locked so the cache can
+    be shared by threads.
+    """
+    def __init__(self, filename):
+        """
+        :param filename: JSON file of the cache, read if it exists.
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.records = json.load(f)
+
+    def get_record(self, key):
+        """
+        :param key: key of the record.
+        :return: the record, or None.
+        """
+        with self.lock:
+            return self.records.get(key)
+
+    def put_record(self, key, record):
+        """
+        Stores a record and writes the cache to disk.
+        :param key: key of the record.
+        :param record: JSON serializable record.
+        """
+        with self.lock:
+            self.records[key] = record
+            self._save()
+
+    def remove_record(self, key):
+        """
+        Removes a record, if present, and writes the cache to disk.
+        :param key: key of the record.
+        """
+        with self.lock:
+            self.records.pop(key, None)
+            self._save()
+
+    def save(self):
+        """
+        Writes the cache to disk.
+        """
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        # the temporary file is unique to this write
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.filename) + '.',
+                                   dir=os.path.dirname(os.path.abspath(self.filename)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.records, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.filename)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
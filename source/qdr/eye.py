@@ -0,0 +1,159 @@
+'''
+QDR eye analysis.
+
+Finds the passing window of each bit, and the tap to calibrate it to, from
+the fail masks of a scan over the delay taps, for all bits at once.
+'''
+
+import numpy
+
+def fail_bits(fail, n_bits=32):
+    "Boolean array of (n_steps, n_bits), True where a bit failed at a step."
+    fail = numpy.asarray(fail, dtype=numpy.int64)
+    return ((fail[:, numpy.newaxis] >> numpy.arange(n_bits)) & 1).astype(bool)
+
+def find_cal_areas(A):
+    """
+    The largest sum contiguous window of each column of A, an (n_steps,
+    n_bits) array, at once.  Returns arrays with the sum, first and last step
+    of the window of each column.
+
+    This gives the same windows as the scalar Kadane scan the calibration
+    used, which counts A[0] twice when it is not negative and prefers the
+    last of equal windows.  With prefix sums
+    P (P[0] = 0), the running sum ending at step i is P[i+1] - min(P[:i+1]), and
+    its window starts at the first step where that minimum is reached.
+    """
+    A = numpy.asarray(A, dtype=numpy.int64)
+    n_steps, n_bits = A.shape
+    B = A.copy()
+    B[0] = numpy.where(A[0] < 0, A[0], 2*A[0])
+    P = numpy.vstack((numpy.zeros(n_bits, dtype=numpy.int64), numpy.cumsum(B, axis=0)))
+    run_min = numpy.minimum.accumulate(P[:-1], axis=0)
+    ending_here = P[1:] - run_min
+    area = ending_here.max(axis=0)
+    stop = n_steps - 1 - numpy.argmax(ending_here[::-1] == area, axis=0)
+    at_min = P[:-1] == run_min[stop, numpy.arange(n_bits)]
+    start = numpy.argmax(at_min & (numpy.arange(n_steps)[:, numpy.newaxis] <= stop), axis=0)
+    return area, start, stop
+
+def step_masks(delays):
+    """
+    Bit masks to step the taps of the bits with one step each, so that bit b
+    is stepped delays[b] times.  Returns one mask per step, up to max(delays).
+    """
+    delays = numpy.asarray(delays)
+    n_steps = int(delays.max()) if len(delays) > 0 else 0
+    stepping = numpy.arange(n_steps)[:, numpy.newaxis] < delays[numpy.newaxis, :]
+    return [int(m) for m in numpy.dot(stepping, numpy.int64(1) << numpy.arange(len(delays), dtype=numpy.int64))]
+
+class Eye(object):
+    """
+    The eye of a scan over the input delay taps of a QDR.  From the fail mask
+    of each step, finds for each bit the largest passing window (area, start,
+    stop) and the tap in its middle.  Bits n_bits..n_all_bits-1 can't be
+    checked, they get the median tap of all the bits (counting themselves
+    as 0).
+    """
+    def __init__(self, fail, n_bits=32, n_all_bits=36):
+        self.fail = numpy.asarray(fail, dtype=numpy.int64)
+        self.n_bits = n_bits
+        self.failed = fail_bits(self.fail, n_bits)
+        # +1 for pass, -1 for fail
+        self.bit_cal = 1 - 2*self.failed.astype(int)
+        self.area, self.start, self.stop = find_cal_areas(self.bit_cal)
+        self.taps = numpy.zeros(n_all_bits)
+        self.taps[:n_bits] = (self.start + self.stop) // 2
+        # as the original calibration, the median includes the unset taps
+        self.median_taps = numpy.median(self.taps)
+        self.taps[n_bits:] = self.median_taps
+
+    def table(self):
+        "The fail mask of each tap step, 0 is pass and 1 is fail."
+        return '\n'.join(['\tTap step %2i:  ' % step + "{0:032b}".format(int(fail))
+                          for step, fail in enumerate(self.fail)])
+
+    def bit_table(self):
+        "The window and selected tap of each bit."
+        lines = ['Selected tap for bit %i: %i (start: %i, stop: %i)' % (bit, self.taps[bit], self.start[bit], self.stop[bit])
+                 for bit in range(self.n_bits)]
+        lines += ['Selected tap for bit %i: %i' % (bit, self.taps[bit]) for bit in range(self.n_bits, len(self.taps))]
+        return '\n'.join(lines)
+
+def coarse_taps(n_taps, coarse):
+    "Every coarse'th tap, and the last one."
+    return sorted(set(range(0, n_taps, coarse)) | set([n_taps - 1]))
+
+def split_blocks(fail, sampled, blocks):
+    """
+    One refinement of a 2-D (out, in) scan.  blocks are (out0, out1, in0, in1)
+    with their four corners sampled.  A block whose corners have the same fail
+    mask has its centre sampled too, and if that also has the mask the block
+    is taken to have it all over and its points that weren't sampled are
+    filled with it.  The others are split in two along each side longer than
+    one tap.  Returns the new blocks and the (out, in) points that must be
+    sampled for them.  A region narrower than about half a block in both
+    directions that misses the corners and the centre can still be filled
+    over.
+    """
+    new_blocks = []
+    points = set()
+    for o0, o1, i0, i1 in blocks:
+        corners = fail[[o0, o0, o1, o1], [i0, i1, i0, i1]]
+        centre = ((o0 + o1) // 2, (i0 + i1) // 2)
+        if (corners == corners[0]).all():
+            if not sampled[centre]:
+                # check the centre before filling the block
+                new_blocks.append((o0, o1, i0, i1))
+                points.add(centre)
+                continue
+            if fail[centre] == corners[0]:
+                area = fail[o0:o1+1, i0:i1+1]
+                area[~sampled[o0:o1+1, i0:i1+1]] = corners[0]
+                continue
+        if o1 - o0 <= 1 and i1 - i0 <= 1:
+            continue
+        outs = [o0, (o0 + o1) // 2, o1] if o1 - o0 > 1 else [o0, o1]
+        ins = [i0, (i0 + i1) // 2, i1] if i1 - i0 > 1 else [i0, i1]
+        for a, b in zip(outs[:-1], outs[1:]):
+            for c, d in zip(ins[:-1], ins[1:]):
+                new_blocks.append((a, b, c, d))
+        points.update((o, i) for o in outs for i in ins if not sampled[o, i])
+    return new_blocks, sorted(points)
+
+class Eye2D(object):
+    """
+    The eye of a scan over the output and input delay taps of a QDR.  fail is
+    the (n_out, n_in) array of fail masks, where sampled is False the mask was
+    filled in from the corners of a uniform block.
+    """
+    def __init__(self, fail, sampled, n_bits=32, n_all_bits=36):
+        self.fail = numpy.asarray(fail, dtype=numpy.int64)
+        self.sampled = numpy.asarray(sampled, dtype=bool)
+        self.n_bits = n_bits
+        self.n_all_bits = n_all_bits
+        # (n_out, n_in, n_bits), True where the bit failed
+        self.failed = fail_bits(self.fail.ravel(), n_bits).reshape(self.fail.shape + (n_bits,))
+        # number of passing bits at each point
+        self.n_pass = n_bits - self.failed.sum(axis=-1)
+
+    def eye(self, out_tap):
+        "The Eye of the input taps at out_tap."
+        return Eye(self.fail[out_tap], self.n_bits, self.n_all_bits)
+
+    def min_areas(self):
+        "The smallest window area of the bits at each out tap."
+        return numpy.array([find_cal_areas(1 - 2*row.astype(int))[0].min() for row in self.failed])
+
+    def best_out(self):
+        "The out tap where the narrowest window of the bits is widest."
+        return int(numpy.argmax(self.min_areas()))
+
+    def table(self):
+        "The number of passing bits at each point, one line per out tap."
+        return '\n'.join(['\tOut %2i:  ' % out + ' '.join(['%2i' % n for n in row])
+                          for out, row in enumerate(self.n_pass)])
+
+    def save(self, filename):
+        "Saves the fail masks and which were sampled to a .npz file."
+        numpy.savez(filename, fail=self.fail, sampled=self.sampled)
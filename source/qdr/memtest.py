@@ -0,0 +1,76 @@
+'''
+QDR memory test patterns.
+
+Builds the data of march, address and pseudo-random pattern tests for whole
+blocks of 32 bit words, and collects the failing bits and addresses of the
+reads, for Qdr.memory_test.
+'''
+
+import numpy
+
+WORD = numpy.dtype('>u4')
+
+# March C- elements as (ascending, read, write): read the background (False)
+# or its complement (True), or None to skip the read or write.
+MARCH_C = [
+    (True, None, False),
+    (True, False, True),
+    (True, True, False),
+    (False, False, True),
+    (False, True, False),
+    (True, False, None),
+    ]
+
+def background_words(background, invert, n_words):
+    "n_words of the background word, or of its complement if invert."
+    if invert:
+        background = ~background & 0xffffffff
+    return numpy.full(n_words, background, dtype=WORD)
+
+def address_words(offset, n_words, invert=False):
+    "The word address of each word of a block at byte offset (or its complement)."
+    words = numpy.arange(offset // 4, offset // 4 + n_words, dtype=numpy.uint32)
+    if invert:
+        words = ~words
+    return words.astype(WORD)
+
+def random_words(seed, n_words, invert=False):
+    "n_words pseudo-random words, the same for the same seed (or their complement)."
+    words = numpy.frombuffer(numpy.random.RandomState(seed).bytes(4 * n_words), dtype=WORD)
+    if invert:
+        words = (~words).astype(WORD)
+    return words
+
+class MemTestErrors(object):
+    """
+    The errors found by a memory test: the number of failing word reads and
+    of errors in each bit, the mask of the failing bits and the byte
+    addresses of the first max_addresses failing reads.
+    """
+    def __init__(self, max_addresses=1000, n_bits=32):
+        self.max_addresses = max_addresses
+        self.n_errors = 0
+        self.fail_bits = 0
+        self.bit_errors = numpy.zeros(n_bits, dtype=numpy.int64)
+        self.addresses = []
+
+    def check(self, expected, got, offset):
+        "Compares the words read from byte offset with the expected ones."
+        diff = numpy.bitwise_xor(expected, got)
+        bad = numpy.flatnonzero(diff)
+        if bad.size == 0:
+            return
+        diff = diff[bad].astype(numpy.int64)
+        self.n_errors += bad.size
+        self.fail_bits |= int(numpy.bitwise_or.reduce(diff))
+        self.bit_errors += ((diff[:, numpy.newaxis] >> numpy.arange(len(self.bit_errors))) & 1).sum(axis=0)
+        room = self.max_addresses - len(self.addresses)
+        if room > 0:
+            self.addresses.extend((offset + 4 * bad[:room]).tolist())
+
+    def report(self):
+        return {'ok': self.n_errors == 0,
+                'n_errors': self.n_errors,
+                'fail_bits': self.fail_bits,
+                'bit_errors': self.bit_errors,
+                'addresses': self.addresses}
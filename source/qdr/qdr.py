@@ -4,7 +4,14 @@
 QDR calibration functions.
 '''
 
-import struct, sys, logging, socket, numpy
+import sys, logging, socket, numpy
+import time, threading
+
+from ..helper_functions import JsonCache, get_bof_hash
+from eye import Eye, Eye2D, step_masks, coarse_taps, split_blocks
+import memtest
+
+LOGGER = logging.getLogger(__name__)
 
 CAL_DATA = [
                 [0xAAAAAAAA,0x55555555,0xAAAAAAAA,0x55555555,0xAAAAAAAA,0x55555555,
@@ -20,23 +27,40 @@ CAL_DATA = [
                 numpy.arange(256)<<24,
                 ]
 
-def find_cal_area(A):
-    max_so_far  = A[0]
-    max_ending_here = A[0]
-    begin_index = 0
-    begin_temp = 0
-    end_index = 0
-    for i in range(len(A)):
-        if (max_ending_here < 0):
-                max_ending_here = A[i]
-                begin_temp = i
-        else:
-                max_ending_here += A[i]
-        if(max_ending_here >= max_so_far ):
-                max_so_far  = max_ending_here;
-                begin_index = begin_temp;
-                end_index = i;
-    return max_so_far,begin_index,end_index
+# All the calibration patterns in one contiguous block of big-endian words,
+# so they are written and read back in a single transfer each way.
+CAL_BLOCK = numpy.concatenate([numpy.asarray(pattern) for pattern in CAL_DATA]).astype('>u4')
+CAL_OFFSET = 2**22
+# the calibration patterns are at the top half of the memory
+MEMORY_BYTES = 2**23
+# default size of the reads and writes of the bulk transfers, small enough
+# not to hit the katcp timeout
+CHUNK_BYTES = 2**16
+
+class QdrCalCache(JsonCache):
+    """
+    On-disk (JSON) record of the calibration of each (board, qdr, bof,
+    clock_speed): the input delays of the 36 bits, the output/clock delay and
+    the extra latency flag.  These are reproducible for a given board,
+    bitstream and clock, so Qdr.qdr_cal can try them before scanning.
+    bof has to identify the bitstream, see helper_functions.get_bof_hash.
+    A cache can be shared by threads, see calibrate_all_qdrs.
+    """
+    def get_key(self, board, qdr_name, bof, clock_speed):
+        return '%s|%s|%s|%s' % (board, qdr_name, get_bof_hash(bof), clock_speed)
+
+    def get(self, board, qdr_name, bof, clock_speed):
+        "Returns the calibration record, or None."
+        return self.get_record(self.get_key(board, qdr_name, bof, clock_speed))
+
+    def put(self, board, qdr_name, bof, clock_speed, in_delays, out_delay, extra_clk):
+        "Stores a calibration record and writes the cache to disk."
+        self.put_record(self.get_key(board, qdr_name, bof, clock_speed), {
+            'in_delays': [float(d) for d in in_delays],
+            'out_delay': int(out_delay),
+            'extra_clk': bool(extra_clk),
+            'time': time.strftime('%Y-%m-%d-%H%M%S'),
+            })
 
 class Qdr(object):
     """
@@ -52,6 +76,8 @@ class Qdr(object):
         self.memory = self.which_qdr + '_memory'
         self.control_mem = self.which_qdr + '_ctrl'
         self.clock_speed = clock_speed # in MHz
+        self.chunk_bytes = CHUNK_BYTES
+        self.transfer_rate = None # MB/s of the last bulk transfer
 
     def from_device_info(cls, parent, device_name, device_info, memorymap_dict):
         """
@@ -164,19 +190,25 @@ class Qdr(object):
             raise RuntimeError("Counter values not the same -- logic error! Got back %i."%raw)
         return raw&(0x1f)
 
+    def cal_pattern_fail(self, verbosity=0):
+        """
+        Writes the calibration patterns to memory and reads them back, in a single
+        transfer each way. Returns the mask of the bits that failed in any word.
+        """
+        self.parent.blindwrite(self.memory, CAL_BLOCK.tostring(), offset=CAL_OFFSET)
+        retdat = numpy.frombuffer(self.parent.read(self.memory, CAL_BLOCK.nbytes, offset=CAL_OFFSET), dtype='>u4')
+        patfail = numpy.bitwise_or.accumulate(CAL_BLOCK ^ retdat)
+        if verbosity > 2:
+            for word_n, word in enumerate(CAL_BLOCK):
+                print "{0:032b}".format(word),
+                print "{0:032b}".format(retdat[word_n]),
+                print "{0:032b}".format(patfail[word_n])
+        return int(patfail[-1])
+
     def qdr_cal_check(self,verbosity=0):
         "checks calibration on a qdr. Raises an exception if it failed."
         self.disable_fabric() #disable the simulink write interface
-        patfail=0
-        for pattern in CAL_DATA:
-            self.parent.blindwrite(self.memory,struct.pack('>%iL'%len(pattern),*pattern), offset=2**22)
-            retdat=struct.unpack('>%iL'%len(pattern), self.parent.read(self.memory,len(pattern)*4, offset=2**22))
-            for word_n,word in enumerate(pattern):
-                patfail=patfail|(word ^ retdat[word_n])
-                if verbosity>2:
-                    print "{0:032b}".format(word),
-                    print "{0:032b}".format(retdat[word_n]),
-                    print "{0:032b}".format(patfail)
+        patfail = self.cal_pattern_fail(verbosity)
         if patfail>0:
             #raise RuntimeError ("Calibration of QDR%i failed: 0b%s."%(qdr,"{0:032b}".format(patfail)))
             return False
@@ -185,69 +217,34 @@ class Qdr(object):
 
 
     def find_in_delays(self, verbosity=0):
+        """
+        Scans the 32 input delay taps of all bits, keeping the fail mask of each
+        step, and finds the eye of each bit (see eye.Eye, kept in self.eye).
+        Returns the selected taps of the 36 bits and the area, start and stop
+        of the window of the 32 data bits.
+        """
         n_steps=32
         n_bits=32
-        fail=[]
-        bit_cal=[[] for bit in range(n_bits)]
-        #valid_steps=[[] for bit in range(n_bits)]
+        fail=numpy.zeros(n_steps, dtype=numpy.int64)
         for step in range(n_steps):
-            patfail=0
-            for pattern in CAL_DATA:
-                self.parent.blindwrite(self.memory,struct.pack('>%iL'%len(pattern),*pattern), offset=2**22)
-                retdat=struct.unpack('>%iL'%len(pattern), self.parent.read(self.memory,len(pattern)*4, offset=2**22))
-                for word_n,word in enumerate(pattern):
-                    patfail=patfail|(word ^ retdat[word_n])
-                    if verbosity>2:
-                        print '\t %4i %4i'%(step,word_n),
-                        print "{0:032b}".format(word),
-                        print "{0:032b}".format(retdat[word_n]),
-                        print "{0:032b}".format(patfail)
-            fail.append(patfail)
-            for bit in range(n_bits):
-                bit_cal[bit].append(1-2*((fail[step]&(1<<bit))>>bit))
-                #if bit_cal[bit][step]==True:
-                #    valid_steps[bit].append(step)
-            if (verbosity>2):
-                print 'STEP input delays to %i!'%(step+1)
+            fail[step] = self.cal_pattern_fail(verbosity)
             self.qdr_delay_in_step(0xfffffffff,1)
 
+        self.eye = Eye(fail, n_bits, n_bits+4)
+
         if (verbosity > 0):
             print 'Eye for QDR %s (0 is pass, 1 is fail):' % self.name
-            for step in range(n_steps):
-                print '\tTap step %2i: '%step,
-                print "{0:032b}".format(fail[step])
+            print self.eye.table()
 
         if (verbosity > 3):
             for bit in range(n_bits):
                 print 'Bit %2i: '%bit,
-                print bit_cal[bit]
-
-        ##find indices where calibration passed and failed:
-        #for bit in range(n_bits):
-        #    try:
-        #        bit_cal[bit].index(1)
-        #    except ValueError:
-        #        raise RuntimeError("Calibration failed for bit %i."%bit)
-
-        cal_steps = numpy.zeros(n_bits+4)
-        cal_area  = numpy.zeros(n_bits)
-        cal_start = numpy.zeros(n_bits)
-        cal_stop  = numpy.zeros(n_bits)
-        #find the largest contiguous cal area
-        for bit in range(n_bits):
-            cal_area[bit], cal_start[bit], cal_stop[bit] = find_cal_area(bit_cal[bit])
-            cal_steps[bit] = (cal_start[bit] + cal_stop[bit]) // 2
-            if (verbosity > 1):
-                print 'Selected tap for bit %i: %i (start: %i, stop: %i)'%(bit,cal_steps[bit], cal_start[bit], cal_stop[bit])
-        #since we don't have access to bits 32-35, we guess the number of taps required based on the other bits:
-        median_taps=numpy.median(cal_steps)
+                print list(self.eye.bit_cal[:, bit])
+
         if verbosity>1:
-            print "Median taps: %i"%median_taps
-        for bit in range(32,36):
-            cal_steps[bit]=median_taps
-            if (verbosity > 1):
-                print 'Selected tap for bit %i: %i'%(bit,cal_steps[bit])
-        return cal_steps, cal_area, cal_start, cal_stop
+            print "Median taps: %i"%self.eye.median_taps
+            print self.eye.bit_table()
+        return self.eye.taps, self.eye.area, self.eye.start, self.eye.stop
 
     def apply_cals(self,in_delays,out_delays,clk_delay,extra_clk,verbosity=0):
         #reset all the taps to default (0)
@@ -257,19 +254,13 @@ class Qdr(object):
         assert len(in_delays)==36
         assert len(out_delays)==36
         self.qdr_delay_clk_step(clk_delay)
-        for step in range(int(max(in_delays))):
-            mask=0
-            for bit in range(len(in_delays)):
-                mask+=(1<<bit if (step<in_delays[bit]) else 0)
+        for step, mask in enumerate(step_masks(in_delays)):
             if verbosity>1:
                 print 'Step %i'%step,
                 print "{0:036b}".format(mask)
             self.qdr_delay_in_step(mask,1)
 
-        for step in range(int(max(out_delays))):
-            mask=0
-            for bit in range(len(out_delays)):
-                mask+=(1<<bit if (step<out_delays[bit]) else 0)
+        for step, mask in enumerate(step_masks(out_delays)):
             if verbosity>1:
                 print 'Step out %i'%step,
                 print "{0:036b}".format(mask)
@@ -277,19 +268,7 @@ class Qdr(object):
 
     def qdr_check_cal_any_good(self,verbosity=0):
         "checks calibration on a qdr. returns True if any of the bits were good"
-        patfail=0
-        for pn, pattern in enumerate(CAL_DATA):
-            self.parent.blindwrite(self.memory,struct.pack('>%iL'%len(pattern),*pattern), offset=2**22)
-            retdat=struct.unpack('>%iL'%len(pattern), self.parent.read(self.memory,len(pattern)*4, offset=2**22))
-            for word_n,word in enumerate(pattern):
-                patfail=patfail|(word ^ retdat[word_n])
-                if verbosity>2:
-                    print "{0:032b}".format(word),
-                    print "{0:032b}".format(retdat[word_n]),
-                    print "{0:032b}".format(patfail)
-                if patfail == 0xffffffff:
-                    return False
-        return True
+        return self.cal_pattern_fail(verbosity) != 0xffffffff
 
     def scan_out_to_edge(self, verbosity=0):
         # Step through the possible output delays. When any of the
@@ -307,14 +286,108 @@ class Qdr(object):
                 self.qdr_delay_clk_step(1)
         return out_step
 
-    def qdr_cal(self, fail_hard=True, min_eye_width=8, verbosity=0):
+    def scan_eye_2d(self, coarse=8, extra_clk=False, verbosity=0):
+        """
+        Maps the eye over the output (and clock) and input delay taps.  The
+        taps are sampled every coarse steps, then the blocks between samples
+        whose corners (or, if these agree, centre) differ are split until they
+        agree or are one tap wide, so only the eye edges are sampled densely.
+        An eye narrower than about coarse/2 taps in both directions can be
+        missed, so keep coarse at most the smallest eye width of interest.
+        Returns an Eye2D, also kept in self.eye_2d.
+        """
+        n_taps = 32
+        fail = numpy.zeros((n_taps, n_taps), dtype=numpy.int64)
+        sampled = numpy.zeros((n_taps, n_taps), dtype=bool)
+        self.qdr_reset()
+        self.add_extra_latency(extra_clk)
+        self.disable_fabric()
+        self._eye_pos = [0, 0]
+
+        taps = coarse_taps(n_taps, coarse)
+        points = [(o, i) for o in taps for i in taps]
+        blocks = [(o0, o1, i0, i1) for o0, o1 in zip(taps[:-1], taps[1:])
+                                   for i0, i1 in zip(taps[:-1], taps[1:])]
+        while points:
+            self._sample_eye_points(points, fail, sampled, verbosity)
+            blocks, points = split_blocks(fail, sampled, blocks)
+
+        self.eye_2d = Eye2D(fail, sampled)
+        if verbosity > 0:
+            print '2-D eye for QDR %s (passing bits, %i of %i points sampled):' % (self.name, sampled.sum(), sampled.size)
+            print self.eye_2d.table()
+        return self.eye_2d
+
+    def _sample_eye_points(self, points, fail, sampled, verbosity=0):
+        """
+        Moves to each (out, in) tap of points and stores its fail mask.  The
+        out taps are taken from the nearer end, so the passes of scan_eye_2d
+        go back and forth, and each row from its nearer end.  A pattern check
+        takes fewer transactions than an in tap step, so every tap of a row
+        between its first and last point is sampled on the way.
+        """
+        rows = {}
+        for out_tap, in_tap in points:
+            rows.setdefault(out_tap, []).append(in_tap)
+        out_taps = sorted(rows)
+        if abs(self._eye_pos[0] - out_taps[-1]) < abs(self._eye_pos[0] - out_taps[0]):
+            out_taps.reverse()
+        for out_tap in out_taps:
+            first, last = min(rows[out_tap]), max(rows[out_tap])
+            in_taps = [i for i in range(first, last + 1) if not sampled[out_tap, i]]
+            if abs(self._eye_pos[1] - last) < abs(self._eye_pos[1] - first):
+                in_taps.reverse()
+            for in_tap in in_taps:
+                step = out_tap - self._eye_pos[0]
+                self.qdr_delay_out_step(2**36 - 1, step)
+                self.qdr_delay_clk_step(step)
+                self.qdr_delay_in_step(2**36 - 1, in_tap - self._eye_pos[1])
+                self._eye_pos = [out_tap, in_tap]
+                fail[out_tap, in_tap] = self.cal_pattern_fail(verbosity)
+                sampled[out_tap, in_tap] = True
+
+    def apply_cached_cal(self, cache, board, bof, verbosity=0):
+        """
+        Applies the calibration recorded in cache (a QdrCalCache) for this
+        QDR on board with bof, and checks it.  Returns True if it passes.
+        """
+        record = cache.get(board, self.name, bof, self.clock_speed)
+        if record is None:
+            return False
+        if verbosity > 0:
+            print 'Trying cached calibration of %s from %s' % (self.name, record['time'])
+        self.apply_cals(record['in_delays'],
+                        out_delays=[record['out_delay'] for bit in range(36)],
+                        clk_delay=record['out_delay'], extra_clk=record['extra_clk'], verbosity=verbosity)
+        if self.qdr_cal_check(verbosity):
+            self.enable_fabric() #reenable the simulink write interface
+            return True
+        if verbosity > 0:
+            print 'Cached calibration of %s failed, scanning' % self.name
+        return False
+
+    def qdr_cal(self, fail_hard=True, min_eye_width=8, verbosity=0, cache=None, board=None, bof=None,
+                scan_2d=False):
         """
         Calibrates a QDR controller
         Step output delays until some of the bits reach their eye. Then step input delays
         Returns True if calibrated, raises a runtime exception if it doesn't.
+        If a QdrCalCache is given, the calibration recorded for this board, bof
+        and clock_speed is tried first, and the scan is only done if it fails
+        qdr_cal_check.  A successful scan is recorded in the cache.  The cache
+        is only used if bof is given.
+        If scan_2d, the out delay is the one of the 2-D eye (see scan_eye_2d)
+        where the narrowest bit window is widest, rather than the first where
+        any bit passes.
         :param verbosity:
         :return:
         """
+        if cache is not None and not bof:
+            LOGGER.warning('No bof given for QDR %s, not using the calibration cache' % self.name)
+            cache = None
+        if cache is not None and self.apply_cached_cal(cache, board, bof, verbosity):
+            return True
+
         n_taps = 32
         # reset all delays and set extra latency to zero.
         self.qdr_reset()
@@ -327,12 +400,19 @@ class Qdr(object):
         # completely independent.
         # If no good bits are found, that's fine, we'll just
         # leave the input delay set to the maximum allowed
-        out_step = self.scan_out_to_edge(verbosity)
+        if scan_2d:
+            out_step = self.scan_eye_2d(coarse=min_eye_width, verbosity=verbosity).best_out()
+            self.eye = self.eye_2d.eye(out_step)
+            in_delays0, good_area0, good_starts0, good_stops0 = self.eye.taps, self.eye.area, self.eye.start, self.eye.stop
+            if verbosity > 0:
+                print "--- === Using OUT DELAYS of %i from the 2-D eye === ---" % out_step
+        else:
+            out_step = self.scan_out_to_edge(verbosity)
 
-        if verbosity > 0:
-            print "--- === Trying with OUT DELAYS to %i === ---" % out_step
-        
-        in_delays0, good_area0, good_starts0, good_stops0 = self.find_in_delays(verbosity)
+            if verbosity > 0:
+                print "--- === Trying with OUT DELAYS to %i === ---" % out_step
+
+            in_delays0, good_area0, good_starts0, good_stops0 = self.find_in_delays(verbosity)
         out_delays = out_step
 
         # if any of the calibration eyes are less than some minimum width, and there is
@@ -374,8 +454,14 @@ class Qdr(object):
 
         cal = self.qdr_cal_check(verbosity)
 
-        if self.qdr_cal_check(verbosity):
+        if cal:
             self.enable_fabric() #reenable the simulink write interface
+            if cache is not None:
+                # the QDR is calibrated even if the record can't be saved
+                try:
+                    cache.put(board, self.name, bof, self.clock_speed, in_delays, out_delay, extra_clk)
+                except (IOError, OSError) as e:
+                    LOGGER.error('Could not save the calibration of QDR %s to %s: %s' % (self.name, cache.filename, e))
             return True
         else:
             self.enable_fabric() #reenable the simulink write interface
@@ -384,3 +470,202 @@ class Qdr(object):
             else:
                 return False
 
+
+    def _chunks(self, nbytes, chunk_bytes):
+        "(start, stop) byte ranges of the chunks of a transfer of nbytes."
+        chunk_bytes = chunk_bytes or self.chunk_bytes
+        if chunk_bytes % 4 != 0:
+            raise ValueError('Chunk size must be a multiple of 4 bytes, got %i.' % chunk_bytes)
+        return [(start, min(start + chunk_bytes, nbytes)) for start in range(0, nbytes, chunk_bytes)]
+
+    def _set_rate(self, kind, nbytes, seconds, verbosity):
+        self.transfer_rate = nbytes / 1e6 / max(seconds, 1e-9)
+        if verbosity > 0:
+            print '%s %i bytes of QDR %s in %.3f s (%.2f MB/s)' % (kind, nbytes, self.name, seconds, self.transfer_rate)
+
+    def read_array(self, offset, count, dtype='>u4', out=None, chunk_bytes=None, verbosity=0):
+        """
+        Reads count items of dtype from the QDR memory starting at byte offset,
+        in reads of chunk_bytes (self.chunk_bytes by default).  If out is given
+        (a contiguous array of count items of dtype, e.g. a numpy.memmap) it is
+        filled in place, else a new array is made.  Returns the array, the rate
+        of the transfer in MB/s is kept in self.transfer_rate.
+        """
+        dtype = numpy.dtype(dtype)
+        if out is None:
+            out = numpy.empty(count, dtype=dtype)
+        elif out.dtype != dtype or out.size != count or not out.flags.c_contiguous:
+            raise ValueError('out must be a contiguous array of %i items of %s.' % (count, dtype))
+        raw = out.reshape(-1).view(numpy.uint8)
+        start_time = time.time()
+        for start, stop in self._chunks(raw.size, chunk_bytes):
+            raw[start:stop] = numpy.frombuffer(self.parent.read(self.memory, stop - start, offset=offset + start),
+                                               dtype=numpy.uint8)
+        self._set_rate('Read', raw.size, time.time() - start_time, verbosity)
+        return out
+
+    def write_array(self, data, offset=0, chunk_bytes=None, verbosity=0):
+        """
+        Writes the array data to the QDR memory starting at byte offset, in
+        writes of chunk_bytes (self.chunk_bytes by default).  data is written
+        with its own dtype, so give it the byte order of the memory (e.g.
+        '>u4').  The rate of the transfer in MB/s is kept in self.transfer_rate.
+        """
+        raw = numpy.ascontiguousarray(data).reshape(-1).view(numpy.uint8)
+        start_time = time.time()
+        for start, stop in self._chunks(raw.size, chunk_bytes):
+            self.parent.blindwrite(self.memory, raw[start:stop].tostring(), offset=offset + start)
+        self._set_rate('Wrote', raw.size, time.time() - start_time, verbosity)
+
+    def tune_chunk_bytes(self, sizes=(2**12, 2**14, 2**16, 2**18, 2**20), nbytes=2**20, offset=0, verbosity=0):
+        """
+        Reads nbytes at offset with each chunk size of sizes, and keeps the
+        fastest in self.chunk_bytes.  Sizes that fail (e.g. by timing out) are
+        skipped.  Returns a dict of chunk size: MB/s.
+        """
+        rates = {}
+        buf = numpy.empty(nbytes, dtype=numpy.uint8)
+        for size in sizes:
+            try:
+                self.read_array(offset, nbytes, numpy.uint8, out=buf, chunk_bytes=size)
+            except Exception as e:
+                if verbosity > 0:
+                    print 'Chunks of %i bytes failed: %s' % (size, e)
+                continue
+            rates[size] = self.transfer_rate
+            if verbosity > 0:
+                print 'Chunks of %i bytes: %.2f MB/s' % (size, rates[size])
+        if rates:
+            self.chunk_bytes = max(rates, key=rates.get)
+        return rates
+
+    def memory_test(self, offset=0, nbytes=None, tests=('march', 'address', 'random'),
+                    backgrounds=(0x00000000, 0x55555555), seed=0, max_addresses=1000, verbosity=0):
+        """
+        Tests nbytes of the QDR memory from byte offset (all of it from offset
+        by default) with bulk transfers of self.chunk_bytes:
+        'march': March C- over each background word, applied to one chunk at
+            a time rather than one word at a time,
+        'address': each word written with its address, then its complement,
+        'random': pseudo-random words from seed, then their complement.
+        The fabric write interface is disabled during the test.  Returns a
+        report dict of each test (see memtest.MemTestErrors.report, plus
+        'bytes' moved, 'time' and 'rate' in MB/s) and 'ok' for all of them.
+        """
+        if nbytes is None:
+            nbytes = MEMORY_BYTES - offset
+        if offset % 4 != 0 or nbytes % 4 != 0:
+            raise ValueError('Offset and size must be multiples of 4 bytes.')
+        blocks = [(offset + start, (stop - start) // 4) for start, stop in self._chunks(nbytes, None)]
+        report = {}
+        self.disable_fabric()
+        try:
+            for test in tests:
+                errors = memtest.MemTestErrors(max_addresses)
+                moved = 0
+                start_time = time.time()
+                if test == 'march':
+                    for background in backgrounds:
+                        for ascending, read, write in memtest.MARCH_C:
+                            for block, n_words in (blocks if ascending else blocks[::-1]):
+                                if read is not None:
+                                    got = self.read_array(block, n_words, memtest.WORD)
+                                    errors.check(memtest.background_words(background, read, n_words), got, block)
+                                    moved += 4 * n_words
+                                if write is not None:
+                                    self.write_array(memtest.background_words(background, write, n_words), block)
+                                    moved += 4 * n_words
+                elif test in ('address', 'random'):
+                    for invert in (False, True):
+                        if test == 'address':
+                            data = memtest.address_words(offset, nbytes // 4, invert)
+                        else:
+                            data = memtest.random_words(seed, nbytes // 4, invert)
+                        self.write_array(data, offset)
+                        errors.check(data, self.read_array(offset, nbytes // 4, memtest.WORD), offset)
+                        moved += 2 * nbytes
+                else:
+                    raise ValueError('Unknown memory test %s.' % test)
+                seconds = time.time() - start_time
+                report[test] = errors.report()
+                report[test].update({'bytes': moved, 'time': seconds, 'rate': moved / 1e6 / max(seconds, 1e-9)})
+                if verbosity > 0:
+                    print 'QDR %s %s test: %i errors, failing bits 0b%s, %.1f MB/s' % (
+                        self.name, test, errors.n_errors, '{0:032b}'.format(errors.fail_bits), report[test]['rate'])
+        finally:
+            self.enable_fabric()
+        report['ok'] = all(report[test]['ok'] for test in tests)
+        return report
+
+class _LockedParent(object):
+    """
+    Wraps an FpgaClient so that each call holds a lock, for links that can't
+    take requests from several threads at once.
+    """
+    def __init__(self, parent, lock):
+        self._parent = parent
+        self._lock = lock
+
+    def __getattr__(self, attr):
+        value = getattr(self._parent, attr)
+        if not callable(value):
+            return value
+        def locked(*args, **kwargs):
+            with self._lock:
+                return value(*args, **kwargs)
+        return locked
+
+def calibrate_all_qdrs(boards, names=('qdr0', 'qdr1', 'qdr2', 'qdr3'), clock_speed=None,
+                       fail_hard=False, min_eye_width=8, verbosity=0, cache=None, bofs=None,
+                       lock_boards=False):
+    """
+    Calibrates the QDRs names of all boards at once, with one thread per QDR,
+    so that the time taken is that of the slowest QDR rather than the sum.
+    boards is a dict of board name: FpgaClient (or a list of FpgaClients,
+    named by their host).  cache and bofs (a dict of board name: bof) are
+    passed to Qdr.qdr_cal.  If lock_boards, the QDRs of a board take turns
+    on its link for each transaction.
+    Returns a dict of (board name, qdr name): report, where the report has
+    'ok', 'time' (seconds) and 'error' (the exception, if any), and raises a
+    RuntimeError at the end if fail_hard and any QDR failed.
+    """
+    if not isinstance(boards, dict):
+        boards = dict((getattr(fpga, 'host', str(i)), fpga) for i, fpga in enumerate(boards))
+    if bofs is None:
+        bofs = {}
+    report = {}
+
+    def cal(board, qdr):
+        start = time.time()
+        try:
+            ok = qdr.qdr_cal(fail_hard=False, min_eye_width=min_eye_width, verbosity=verbosity,
+                             cache=cache, board=board, bof=bofs.get(board))
+            error = None
+        except Exception as e:
+            ok = False
+            error = e
+        report[(board, qdr.name)] = {'ok': ok, 'time': time.time() - start, 'error': error}
+
+    threads = []
+    start = time.time()
+    for board, fpga in boards.items():
+        if lock_boards:
+            fpga = _LockedParent(fpga, threading.Lock())
+        for name in names:
+            qdr = Qdr(fpga, name, clock_speed=clock_speed)
+            threads.append(threading.Thread(target=cal, args=(board, qdr), name='%s:%s' % (board, name)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if verbosity > 0:
+        for key in sorted(report):
+            r = report[key]
+            print '%s %s: %s in %.1f s%s' % (key[0], key[1], 'calibrated' if r['ok'] else 'FAILED',
+                                              r['time'], '' if r['error'] is None else ' (%s)' % r['error'])
+        print 'Calibrated %i QDRs in %.1f s' % (len(report), time.time() - start)
+    failed = sorted(key for key in report if not report[key]['ok'])
+    if fail_hard and failed:
+        raise RuntimeError('QDR calibration failed for %s.' % ', '.join('%s %s' % key for key in failed))
+    return report